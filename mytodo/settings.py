@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'todo.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,6 +89,37 @@ DATABASES = {
     }
 }
 
+# Read replica for safe API requests, a second SQLite file kept in sync with `manage.py sync_replica`
+if os.getenv('MYTODO_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('MYTODO_REPLICA_DB'),
+        'TEST': {
+            'MIRROR': 'default',
+        },
+    }
+
+# Per-user shards of the `todo` app, `MYTODO_SHARDS` is a comma separated list of extra SQLite files,
+# users are moved between them with `manage.py rebalance_shards`
+SHARDS = ['default']
+for i, name in enumerate(filter(None, os.getenv('MYTODO_SHARDS', '').split(',')), 1):
+    alias = 'shard{0}'.format(i)
+    DATABASES[alias] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': name,
+    }
+    SHARDS.append(alias)
+
+# For how long workers cache the shard of a user, rebalancing waits as long between its steps
+SHARD_CACHE_SECONDS = 10
+
+DATABASE_ROUTERS = ['todo.routers.ReadReplicaRouter', 'todo.routers.ShardRouter']
+
+# For how long reads of a user stick to the primary after the user writes,
+# pins are shared by workers through a separate SQLite file
+REPLICA_PIN_SECONDS = 5
+REPLICA_PINS_DATABASE = os.getenv('MYTODO_REPLICA_PINS_DB', os.path.join(BASE_DIR, 'replica_pins.sqlite3'))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -115,6 +147,17 @@ DATETIME_FORMAT = DATE_FORMAT + ' ' + TIME_FORMAT
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.LimitOffsetPagination',
     'PAGE_SIZE': 100,
+    'DEFAULT_RENDERER_CLASSES': (
+        'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+        'todo.renderers.MessagePackRenderer',
+    ),
+    'DEFAULT_PARSER_CLASSES': (
+        'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+        'todo.parsers.MessagePackParser',
+    ),
     'DATETIME_FORMAT': DATETIME_FORMAT,
     'DATETIME_INPUT_FORMATS': ['iso-8601', DATETIME_FORMAT],
     'DEFAULT_AUTHENTICATION_CLASSES': (
@@ -123,10 +166,71 @@ REST_FRAMEWORK = {
     ),
     'DEFAULT_THROTTLE_RATES': {
         'anon': '100/hour',
-        'user': '250/hour'
+        'user': '250/hour',
+        # Requested on every keystroke
+        'autocomplete': '5000/hour',
+        # Clients poll again as soon as a response comes, at least every `CHANGES_POLL_SECONDS`
+        'changes': '1000/hour',
     }
 }
 
+# Filtered admin lists are counted up to this number of rows, unfiltered ones are estimated
+ADMIN_COUNT_LIMIT = 10000
+
+# For how long admin list filters keep the related objects present in the table
+ADMIN_FILTER_CACHE_SECONDS = 300
+
+# Users the admin action provisions in one transaction (at most 999), see `manage.py provision_users`
+ADMIN_PROVISION_BATCH_SIZE = 500
+
+# Throttle counters are shared by workers through a separate SQLite file
+THROTTLE_DATABASE = os.getenv('MYTODO_THROTTLE_DB', os.path.join(BASE_DIR, 'throttle.sqlite3'))
+
+# Change feed events are shared by workers through a separate SQLite file as well
+CHANGES_DATABASE = os.getenv('MYTODO_CHANGES_DB', os.path.join(BASE_DIR, 'changes.sqlite3'))
+CHANGES_RETENTION_SECONDS = 24 * 60 * 60
+# How often every worker checks for events appended by other workers
+CHANGES_WATCH_INTERVAL = 0.2
+# Longest wait of a long-poll request, the lifetime of an event stream and the interval of its heartbeats
+CHANGES_POLL_SECONDS = 25
+CHANGES_STREAM_SECONDS = 5 * 60
+CHANGES_HEARTBEAT_SECONDS = 15
+# Long-poll and stream clients waiting at once in a worker, each of them holds a thread of a threaded server
+CHANGES_MAX_LISTENERS = 100
+
+# Staff users profile an API request by sending `X-Profile: 1` or `?profile=1`,
+# this share of their other API requests is profiled too, profiles are listed in the admin
+PROFILE_SAMPLE_RATE = 0
+# Seconds between stack samples of a profiled request
+PROFILE_INTERVAL = 0.002
+
+# Snapshots of `manage.py backup_db`, pages shared by snapshots are stored once
+BACKUP_DATABASE = os.getenv('MYTODO_BACKUP_DB', os.path.join(BASE_DIR, 'backups.sqlite3'))
+
+# `manage.py rebalance_positions` respreads todos of categories with positions longer than this,
+# moves into the same gap make them one character longer every few times
+POSITION_REBALANCE_LENGTH = 16
+
+# Requests one call of /api/batch/ may run
+BATCH_MAX_REQUESTS = 20
+
+# Prefix indexes of this many users are kept in memory by every worker for autocomplete,
+# users with more tags and categories than `AUTOCOMPLETE_MAX_NAMES` are always served by the database
+AUTOCOMPLETE_CACHE_USERS = 1000
+AUTOCOMPLETE_MAX_NAMES = 10000
+# Searches answered by the database before the index of a user is built
+AUTOCOMPLETE_BUILD_AFTER = 3
+
+# Metrics of all workers are merged in a separate SQLite file and exposed at `/metrics`
+# to staff users and to scrapers sending `Authorization: Bearer <MYTODO_METRICS_TOKEN>`
+METRICS_DATABASE = os.getenv('MYTODO_METRICS_DB', os.path.join(BASE_DIR, 'metrics.sqlite3'))
+METRICS_TOKEN = os.getenv('MYTODO_METRICS_TOKEN', '')
+# How often every worker writes its metrics into the file
+METRICS_FLUSH_SECONDS = 1
+
+# Keeps the SQLite stores above in memory while tests run
+TEST_RUNNER = 'todo.test_runner.TestRunner'
+
 
 LOGGING = {
     'version': 1,
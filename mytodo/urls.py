@@ -17,9 +17,12 @@ from django.conf.urls import url, include
 from django.contrib import admin
 from rest_framework.authtoken import views
 
+from todo.views import MetricsExposition
+
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^api-auth/', include('rest_framework.urls', namespace='rest_framework')),
     url(r'^api-token-auth/', views.obtain_auth_token),
-    url(r'^api/', include('todo.urls', namespace='todo'))
+    url(r'^api/', include('todo.urls', namespace='todo')),
+    url(r'^metrics$', MetricsExposition.as_view()),
 ]
@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mytodo.settings")
 
 application = get_wsgi_application()
+
+# Primes lazy structures before the server forks workers, only worth it when the application is loaded
+# once in the master (e.g. `gunicorn --preload`), so it is enabled with MYTODO_WARMUP=1
+if os.environ.get('MYTODO_WARMUP') == '1':
+    from todo.warmup import warm_up
+    warm_up(application)
@@ -1,9 +1,55 @@
+from django.conf import settings
+from django.conf.urls import url
 from django.contrib import admin
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.core.urlresolvers import reverse
+from django.db.models import Max
 from django.forms import ModelForm
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.html import format_html
+from django.utils.functional import cached_property
 from django.contrib.auth.models import User
 from django.contrib.auth.admin import UserAdmin as OldUserAdmin
 
-from .models import Todo, Category, Tag, Profile
+from .metrics import metrics
+from .models import Todo, ArchivedTodo, Category, Tag, Profile, RequestProfile
+from .provisioning import MAX_BATCH_SIZE, provision_batch
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Avoids `COUNT(*)` over the whole table: unfiltered lists are estimated by the largest id,
+    filtered ones are counted only up to `ADMIN_COUNT_LIMIT` rows
+    """
+    @cached_property
+    def count(self):
+        query = self.object_list.query
+        if not query.where:
+            return self.object_list.aggregate(max_pk=Max('pk'))['max_pk'] or 0
+        limit = settings.ADMIN_COUNT_LIMIT
+        return self.object_list.order_by()[:limit].count()
+
+
+class CachedRelatedOnlyFieldListFilter(admin.RelatedOnlyFieldListFilter):
+    """
+    Caches the related objects present in the table for `ADMIN_FILTER_CACHE_SECONDS`
+    """
+    def field_choices(self, field, request, model_admin):
+        key = 'todo:admin-filter:{0}:{1}'.format(model_admin.model._meta.label_lower, field.name)
+        choices = cache.get(key)
+        metrics.count_cache_lookup('admin_filter', choices is not None)
+        if choices is None:
+            pks = model_admin.get_queryset(request).order_by().values_list(field.name, flat=True).distinct()
+            choices = field.get_choices(include_blank=False, limit_choices_to={'pk__in': pks})
+            cache.set(key, choices, settings.ADMIN_FILTER_CACHE_SECONDS)
+        return choices
+
+
+class ScalableModelAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class ProfileInline(admin.StackedInline):
@@ -13,6 +59,15 @@ class ProfileInline(admin.StackedInline):
 
 class UserAdmin(OldUserAdmin):
     inlines = (ProfileInline, )
+    actions = ['provision']
+
+    def provision(self, request, queryset):
+        usernames = list(queryset.values_list('username', flat=True))
+        batch_size = min(settings.ADMIN_PROVISION_BATCH_SIZE, MAX_BATCH_SIZE)
+        for i in range(0, len(usernames), batch_size):
+            provision_batch([{'username': username} for username in usernames[i:i + batch_size]])
+        self.message_user(request, 'Profiles and tokens of {0} users provisioned'.format(len(usernames)))
+    provision.short_description = 'Create missing profiles and API tokens'
 
 
 admin.site.unregister(User)
@@ -29,7 +84,11 @@ class MembershipInline(admin.TabularInline):
     def formfield_for_foreignkey(self, db_field, request=None, **kwargs):
         if db_field.name == 'tag':
             kwargs['queryset'] = Tag.objects.filter(user__pk=request.saved_user_pk)
-        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+        formfield = super().formfield_for_foreignkey(db_field, request, **kwargs)
+        if db_field.name == 'tag':
+            # Evaluated once and copied to every row instead of querying tags for each of them
+            formfield.choices = list(formfield.choices)
+        return formfield
 
 
 class TodoAdminForm(ModelForm):
@@ -39,13 +98,14 @@ class TodoAdminForm(ModelForm):
 
 
 @admin.register(Todo)
-class TodoAdmin(admin.ModelAdmin):
+class TodoAdmin(ScalableModelAdmin):
     form = TodoAdminForm
     date_hierarchy = 'deadline'
     list_display = ('text', 'category', 'user', 'deadline', 'is_done')
+    list_select_related = ('category', 'user')
     list_editable = ('is_done',)
     list_filter = (
-        ('user', admin.RelatedOnlyFieldListFilter),
+        ('user', CachedRelatedOnlyFieldListFilter),
         ('is_done', admin.BooleanFieldListFilter),
     )
     search_fields = ('text', 'user__username', 'category__name',)
@@ -56,19 +116,79 @@ class TodoAdmin(admin.ModelAdmin):
 
 
 @admin.register(Category)
-class CategoryAdmin(admin.ModelAdmin):
+class CategoryAdmin(ScalableModelAdmin):
     fields = ('name', 'user')
     list_display = ('name', 'user')
+    list_select_related = ('user',)
     list_filter = (
-        ('user', admin.RelatedOnlyFieldListFilter),
+        ('user', CachedRelatedOnlyFieldListFilter),
     )
 
 
 @admin.register(Tag)
-class TagAdmin(admin.ModelAdmin):
+class TagAdmin(ScalableModelAdmin):
     fields = ('name', 'user', 'color')
     list_display = ('colored_name', 'user', 'color')
+    list_select_related = ('user',)
     list_filter = (
-        ('user', admin.RelatedOnlyFieldListFilter),
+        ('user', CachedRelatedOnlyFieldListFilter),
     )
 
+
+@admin.register(ArchivedTodo)
+class ArchivedTodoAdmin(ScalableModelAdmin):
+    list_display = ('text', 'category', 'user', 'deadline', 'archived_at')
+    list_select_related = ('category', 'user')
+    list_filter = (
+        ('user', CachedRelatedOnlyFieldListFilter),
+    )
+    search_fields = ('text', 'user__username', 'category__name',)
+    actions = ['restore']
+
+    def restore(self, request, queryset):
+        for archived_todo in queryset:
+            archived_todo.restore()
+        self.message_user(request, '{0} todos restored'.format(len(queryset)))
+    restore.short_description = 'Restore selected todos'
+
+
+@admin.register(RequestProfile)
+class RequestProfileAdmin(ScalableModelAdmin):
+    list_display = ('created', 'user', 'method', 'path', 'status_code', 'duration', 'query_count', 'sql_duration',
+                    'downloads')
+    list_select_related = ('user',)
+    list_filter = ('method', 'status_code')
+    search_fields = ('path', 'user__username')
+    readonly_fields = ('user', 'created', 'method', 'path', 'status_code', 'duration', 'query_count',
+                       'sql_duration', 'downloads', 'queries')
+    exclude = ('stacks',)
+
+    # Files a profile can be downloaded as: name suffix, field, content type
+    DOWNLOADS = {
+        'stacks': ('folded', 'stacks', 'text/plain'),
+        'sql': ('sql.json', 'queries', 'application/json'),
+    }
+
+    def has_add_permission(self, request):
+        return False
+
+    def get_urls(self):
+        return [
+            url(r'^(?P<pk>[0-9]+)/download/(?P<kind>stacks|sql)/$', self.admin_site.admin_view(self.download),
+                name='todo_requestprofile_download'),
+        ] + super().get_urls()
+
+    def download(self, request, pk, kind):
+        if not self.has_change_permission(request):
+            return HttpResponse(status=403)
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        suffix, field, content_type = self.DOWNLOADS[kind]
+        response = HttpResponse(getattr(profile, field), content_type=content_type)
+        response['Content-Disposition'] = 'attachment; filename="profile-{0}.{1}"'.format(profile.pk, suffix)
+        return response
+
+    def downloads(self, obj):
+        return format_html('<a href="{0}">stacks</a> / <a href="{1}">SQL</a>',
+                           reverse('admin:todo_requestprofile_download', args=(obj.pk, 'stacks')),
+                           reverse('admin:todo_requestprofile_download', args=(obj.pk, 'sql')))
+    downloads.short_description = 'Download'
@@ -0,0 +1,148 @@
+import collections
+import heapq
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.db.models import Count, Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from .changes import change_log
+from .models import Category, Tag, Todo
+
+KINDS = {'tag': Tag, 'category': Category}
+
+Entry = collections.namedtuple('Entry', ('key', 'kind', 'id', 'name', 'usage'))
+
+
+def rank(entry):
+    # Most used first, then alphabetically
+    return -entry.usage, entry.key, entry.kind
+
+
+class PrefixIndex(object):
+    """
+    Tag and category names of a user sorted case-insensitively, a prefix is a contiguous range found by bisection
+    """
+    def __init__(self, entries, change_id):
+        """
+        :param change_id: last change log event of the user the index includes
+        """
+        self.entries = sorted(entries, key=lambda entry: entry.key)
+        self.keys = [entry.key for entry in self.entries]
+        self.change_id = change_id
+
+    def search(self, prefix, kinds, limit):
+        key = prefix.casefold()
+        matches = self.entries[bisect_left(self.keys, key):bisect_left(self.keys, key + '\U0010ffff')]
+        return heapq.nsmallest(limit, (entry for entry in matches if entry.kind in kinds), key=rank)
+
+
+def load_entries(user, kinds=tuple(KINDS), queryset_filter=None):
+    """
+    :param kinds: names of `KINDS` to load
+    :param queryset_filter: Q object applied to tags and categories
+    :return: list of `Entry` with the number of todos using each tag and category
+    """
+    entries = []
+    for kind in kinds:
+        q = KINDS[kind].objects.for_user(user)
+        if queryset_filter is not None:
+            q = q.filter(queryset_filter)
+        entries.extend(Entry(name.casefold(), kind, pk, name, usage)
+                       for pk, name, usage in q.annotate(usage=Count('todo')).values_list('pk', 'name', 'usage'))
+    return entries
+
+
+class Autocomplete(object):
+    """
+    In-memory prefix indexes of recently active users, least recently used ones are evicted
+
+    Changes made by this process drop the index of the user through model signals,
+    changes made by other workers are noticed by the last change log event of the user.
+    An index is built after `AUTOCOMPLETE_BUILD_AFTER` searches of the user are answered by the database,
+    so a single search doesn't pay for loading all names
+    """
+    def __init__(self):
+        self._indexes = collections.OrderedDict()
+        # Searches answered by the database by user id, least recent first
+        self._misses = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def forget(self, user_pk):
+        with self._lock:
+            self._indexes.pop(user_pk, None)
+
+    def clear(self):
+        with self._lock:
+            self._indexes.clear()
+            self._misses.clear()
+
+    def _missed(self, user_pk):
+        """
+        :return: True if the user has searched often enough for an index to pay off
+        """
+        with self._lock:
+            misses = self._misses.pop(user_pk, 0) + 1
+            if misses >= settings.AUTOCOMPLETE_BUILD_AFTER:
+                return True
+            self._misses[user_pk] = misses
+            while len(self._misses) > settings.AUTOCOMPLETE_CACHE_USERS:
+                self._misses.popitem(last=False)
+            return False
+
+    def _get(self, user_pk, change_id):
+        with self._lock:
+            index = self._indexes.get(user_pk)
+            if index is not None and index.change_id == change_id:
+                self._indexes.move_to_end(user_pk)
+                return index
+        return None
+
+    def _build(self, user, change_id):
+        entries = load_entries(user)
+        if len(entries) > settings.AUTOCOMPLETE_MAX_NAMES:
+            return
+        with self._lock:
+            self._indexes[user.pk] = PrefixIndex(entries, change_id)
+            self._indexes.move_to_end(user.pk)
+            while len(self._indexes) > settings.AUTOCOMPLETE_CACHE_USERS:
+                self._indexes.popitem(last=False)
+
+    @staticmethod
+    def _search_database(user, prefix, kinds, limit):
+        # Range lookups use the B-tree index on `name`, they are case-sensitive,
+        # so the prefix is tried as typed, in lower case and capitalized. Unlike the case-folded index,
+        # this misses names with other capitals, e.g. `workO` doesn't find `WorkOut`
+        condition = Q()
+        for variant in {prefix, prefix.lower(), prefix[:1].upper() + prefix[1:].lower()}:
+            condition |= Q(name__gte=variant, name__lt=variant + '\U0010ffff')
+        return heapq.nsmallest(limit, load_entries(user, kinds, condition), key=rank)
+
+    def search(self, user, prefix, kinds=tuple(KINDS), limit=10):
+        """
+        :return: list of `Entry`, most used first
+        """
+        # Read before loading names, so changes committed meanwhile make the index stale rather than lost
+        change_id = change_log.last_id_of_user(user.pk)
+        index = self._get(user.pk, change_id)
+        if index is not None:
+            return index.search(prefix, kinds, limit)
+        result = self._search_database(user, prefix, kinds, limit)
+        if self._missed(user.pk):
+            # Following keystrokes are answered from memory
+            self._build(user, change_id)
+        return result
+
+
+autocomplete = Autocomplete()
+
+
+# Connected here rather than in models.py: processes that never import the index have nothing to drop
+@receiver((post_save, post_delete), sender=Todo)
+@receiver((post_save, post_delete), sender=Tag)
+@receiver((post_save, post_delete), sender=Category)
+@receiver(m2m_changed, sender=Todo.tags.through)
+def forget_autocomplete_index(sender, instance, **kwargs):
+    autocomplete.forget(instance.user_id)
@@ -0,0 +1,264 @@
+import hashlib
+import itertools
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from django.contrib.auth import get_user_model
+from django.core import serializers
+from django.db import transaction
+
+from .changes import change_log
+from .models import UserShard, Profile, Category, Tag, Todo
+from .sharding import TAGGED_MODELS, delete_user
+
+# Rows of a user, in the order they can be inserted
+USER_MODELS = (Profile, Category, Tag) + TAGGED_MODELS
+# Models whose changes are published to the change feed
+PUBLISHED_MODELS = (Category, Tag, Todo)
+# Times a copy may start over because of writes to the database before it gives up
+MAX_RESTARTS = 10
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+def copy_online(source_path, target_path, pages, sleep, progress=None, max_restarts=MAX_RESTARTS):
+    """
+    Copies a live SQLite database with the online backup API, `pages` pages at a time with `sleep` seconds between
+    steps, so writers are locked out only for a step. Writes of other connections restart the copy
+    :raise TooManyRestarts: if the copy starts over more than `max_restarts` times
+    """
+    state = {'remaining': None, 'restarts': 0}
+
+    def step(status, remaining, total):
+        # Remaining pages only go down unless the copy starts over
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > max_restarts:
+                raise TooManyRestarts('Copy of {0} was restarted by writes more than {1} times, '
+                                      'copy more pages in a step or sleep less'.format(source_path, max_restarts))
+        state['remaining'] = remaining
+        if progress is not None:
+            progress(status, remaining, total)
+
+    source = sqlite3.connect(source_path)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target, pages=pages, sleep=sleep, progress=step)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+class SnapshotStore(object):
+    """
+    Snapshots of SQLite databases kept in a SQLite file (`BACKUP_DATABASE`)
+
+    Pages are stored once by their hash, so a snapshot takes only the space of pages that changed
+    since the snapshots before it
+    """
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS page ('
+                                'hash BLOB PRIMARY KEY, '
+                                'data BLOB NOT NULL'
+                                ') WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot ('
+                                'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                'alias TEXT NOT NULL, '
+                                'created REAL NOT NULL, '
+                                'page_size INTEGER NOT NULL, '
+                                'page_count INTEGER NOT NULL, '
+                                'new_pages INTEGER NOT NULL'
+                                ')')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshot_page ('
+                                'snapshot_id INTEGER NOT NULL, '
+                                'page_no INTEGER NOT NULL, '
+                                'hash BLOB NOT NULL, '
+                                'PRIMARY KEY (snapshot_id, page_no)'
+                                ') WITHOUT ROWID')
+
+    def close(self):
+        self.connection.close()
+
+    def take(self, alias, source_path, pages, sleep, progress=None, max_restarts=MAX_RESTARTS):
+        """
+        Snapshots a live database, see `copy_online`
+        :return: dict with `id`, `page_count`, `new_pages` and `page_size` of the snapshot
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot.sqlite3')
+            copy_online(source_path, path, pages, sleep, progress, max_restarts)
+            return self._store(alias, path)
+
+    def _store(self, alias, path):
+        copy = sqlite3.connect(path)
+        page_size = copy.execute('PRAGMA page_size').fetchone()[0]
+        copy.close()
+
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            snapshot_id = connection.execute(
+                'INSERT INTO snapshot (alias, created, page_size, page_count, new_pages) VALUES (?, ?, ?, 0, 0)',
+                (alias, time.time(), page_size)).lastrowid
+            page_count = new_pages = 0
+            with open(path, 'rb') as f:
+                for page_no, data in enumerate(iter(lambda: f.read(page_size), b'')):
+                    digest = hashlib.sha256(data).digest()
+                    new_pages += connection.execute('INSERT OR IGNORE INTO page (hash, data) VALUES (?, ?)',
+                                                    (digest, data)).rowcount
+                    connection.execute('INSERT INTO snapshot_page (snapshot_id, page_no, hash) VALUES (?, ?, ?)',
+                                       (snapshot_id, page_no, digest))
+                    page_count += 1
+            connection.execute('UPDATE snapshot SET page_count = ?, new_pages = ? WHERE id = ?',
+                               (page_count, new_pages, snapshot_id))
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        return {'id': snapshot_id, 'page_count': page_count, 'new_pages': new_pages, 'page_size': page_size}
+
+    def snapshots(self):
+        """
+        :return: list of (id, alias, created, page size, page count, new pages), oldest first
+        """
+        return self.connection.execute('SELECT id, alias, created, page_size, page_count, new_pages '
+                                       'FROM snapshot ORDER BY id').fetchall()
+
+    def get_alias(self, snapshot_id):
+        row = self.connection.execute('SELECT alias FROM snapshot WHERE id = ?', (snapshot_id,)).fetchone()
+        if row is None:
+            raise KeyError(snapshot_id)
+        return row[0]
+
+    def assemble(self, snapshot_id, path):
+        """
+        Writes the database file of the snapshot
+        """
+        self.get_alias(snapshot_id)
+        with open(path, 'wb') as f:
+            for data, in self.connection.execute('SELECT page.data FROM snapshot_page '
+                                                 'JOIN page ON page.hash = snapshot_page.hash '
+                                                 'WHERE snapshot_id = ? ORDER BY page_no', (snapshot_id,)):
+                f.write(data)
+
+    def restore(self, snapshot_id, target_path, pages, sleep, progress=None):
+        """
+        Copies the snapshot into the database with the online backup API, open connections see it once done
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'snapshot.sqlite3')
+            self.assemble(snapshot_id, path)
+            check = sqlite3.connect(path)
+            result = check.execute('PRAGMA quick_check').fetchone()[0]
+            check.close()
+            if result != 'ok':
+                raise ValueError('Snapshot {0} is damaged: {1}'.format(snapshot_id, result))
+            copy_online(path, target_path, pages, sleep, progress)
+
+    def prune(self, keep):
+        """
+        Deletes all but the last `keep` snapshots of every database and pages no snapshot uses anymore
+        :return: number of deleted snapshots
+        """
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            ids = [row[0] for row in connection.execute(
+                'SELECT id FROM snapshot s WHERE (SELECT COUNT(*) FROM snapshot newer '
+                'WHERE newer.alias = s.alias AND newer.id > s.id) >= ?', (keep,))]
+            for snapshot_id in ids:
+                connection.execute('DELETE FROM snapshot_page WHERE snapshot_id = ?', (snapshot_id,))
+                connection.execute('DELETE FROM snapshot WHERE id = ?', (snapshot_id,))
+            connection.execute('DELETE FROM page WHERE hash NOT IN (SELECT hash FROM snapshot_page)')
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        return len(ids)
+
+
+class WriteLockProbe(object):
+    """
+    Measures from a background thread how long a writer waits for the lock it needs to commit
+    """
+    def __init__(self, path, interval=0.01):
+        self.path = path
+        self.interval = interval
+        self.samples = []
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _probe(self):
+        connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        while not self._stopped.wait(self.interval):
+            start = time.perf_counter()
+            # The reserved lock every writer takes first, unlike an exclusive one it doesn't lock readers out
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('ROLLBACK')
+            self.samples.append(time.perf_counter() - start)
+        connection.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._probe, name='write-lock-probe', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return sorted(self.samples)
+
+
+def export_user(user_pk, stream):
+    """
+    Writes the rows of the user as JSON, read in one transaction so they are consistent
+    :return: number of exported rows
+    """
+    alias = UserShard.get_alias(user_pk)
+    with transaction.atomic(using=alias):
+        objects = list(itertools.chain.from_iterable(
+            model.objects.using(alias).filter(user_id=user_pk) for model in USER_MODELS))
+        serializers.serialize('json', objects, stream=stream, indent=2)
+    return len(objects)
+
+
+def import_user(stream):
+    """
+    Replaces the rows of a user with the rows of an export, other users are not touched
+    :return: (user id, number of imported rows)
+    """
+    deserialized = list(serializers.deserialize('json', stream))
+    user_pks = {item.object.user_id for item in deserialized}
+    if len(user_pks) != 1 or any(not isinstance(item.object, USER_MODELS) for item in deserialized):
+        raise ValueError('An export has to contain rows of exactly one user')
+    user_pk = user_pks.pop()
+    if not get_user_model().objects.filter(pk=user_pk).exists():
+        raise ValueError('User {0} does not exist'.format(user_pk))
+
+    alias = UserShard.get_alias(user_pk)
+    with transaction.atomic(using=alias):
+        events = [(user_pk, model._meta.model_name, pk, 'delete') for model in PUBLISHED_MODELS
+                  for pk in model.objects.using(alias).filter(user_id=user_pk).values_list('pk', flat=True)]
+        delete_user(user_pk, alias)
+        # Bulk inserts skip signals, which would create and delete default categories on the way
+        for model in USER_MODELS:
+            model.objects.using(alias).bulk_create(item.object for item in deserialized if type(item.object) is model)
+        for model in TAGGED_MODELS:
+            through = model.tags.through
+            through.objects.using(alias).bulk_create(
+                through(**{model._meta.model_name + '_id': item.object.pk, 'tag_id': tag_pk})
+                for item in deserialized if type(item.object) is model for tag_pk in item.m2m_data.get('tags', ()))
+        events.extend((user_pk, item.object._meta.model_name, item.object.pk, 'create')
+                      for item in deserialized if type(item.object) in PUBLISHED_MODELS)
+        transaction.on_commit(lambda: change_log.append_many(events), using=alias)
+    return user_pk, len(deserialized)
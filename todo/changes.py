@@ -0,0 +1,196 @@
+import contextlib
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class TooManyListeners(Exception):
+    pass
+
+
+class ChangeLog(object):
+    """
+    Log of per-user change events kept in a SQLite file (`CHANGES_DATABASE`) shared by workers
+
+    Waiting clients sleep on events of their own, set by appends of this process for the users of
+    the new events and by a single watcher thread per process, which notices commits of other processes
+    through `PRAGMA data_version` and finds their users with one query. Every waiting client holds
+    a thread of the server, so the feed needs a threaded server and `listening` caps clients of a process
+    """
+    PRUNE_EVERY = 1000
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Lists of `threading.Event` of waiting clients by user id
+        self._waiters = {}
+        self._listeners = 0
+        self._watcher = None
+        self._appends = 0
+
+    def _connect(self, path):
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS change ('
+                           'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                           'user_id INTEGER NOT NULL, '
+                           'model TEXT NOT NULL, '
+                           'object_id INTEGER NOT NULL, '
+                           'action TEXT NOT NULL, '
+                           'created REAL NOT NULL'
+                           ')')
+        connection.execute('CREATE INDEX IF NOT EXISTS change_user_id ON change (user_id, id)')
+        return connection
+
+    @property
+    def connection(self):
+        path = settings.CHANGES_DATABASE
+        if getattr(self._local, 'path', None) != path:
+            self._local.connection = self._connect(path)
+            self._local.path = path
+        return self._local.connection
+
+    def append_many(self, events):
+        """
+        Appends are run after the changes are committed, so errors are logged and the events lost
+        instead of failing a request whose changes are saved
+        :param events: iterable of (user id, model name, object id, action)
+        """
+        events = list(events)
+        try:
+            self._insert(events)
+        except Exception:
+            logger.exception('Lost %d change events', len(events))
+            return
+        self._wake({event[0] for event in events})
+
+    def _insert(self, events):
+        now = time.time()
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT INTO change (user_id, model, object_id, action, created) '
+                                   'VALUES (?, ?, ?, ?, ?)', [event + (now,) for event in events])
+            self._appends += 1
+            if self._appends % self.PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM change WHERE created < ?', (now - settings.CHANGES_RETENTION_SECONDS,))
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+
+    def append(self, user_pk, model, object_pk, action):
+        self.append_many([(user_pk, model, object_pk, action)])
+
+    def last_id(self):
+        return self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM change').fetchone()[0]
+
+    def last_id_of_user(self, user_pk):
+        return self.connection.execute('SELECT COALESCE(MAX(id), 0) FROM change WHERE user_id = ?',
+                                       (user_pk,)).fetchone()[0]
+
+    def is_expired(self, since):
+        """
+        :return: True if events after `since` may have been pruned, so the client has to fetch everything again
+        """
+        oldest = self.connection.execute('SELECT MIN(id) FROM change').fetchone()[0]
+        return oldest is not None and since < oldest - 1
+
+    def read(self, user_pk, since, limit=100):
+        rows = self.connection.execute('SELECT id, model, object_id, action, created FROM change '
+                                       'WHERE user_id = ? AND id > ? ORDER BY id LIMIT ?', (user_pk, since, limit))
+        return [{'id': row[0], 'model': row[1], 'object_id': row[2], 'action': row[3], 'created': row[4]}
+                for row in rows]
+
+    def _wake(self, user_pks):
+        with self._lock:
+            for user_pk in user_pks:
+                for waiter in self._waiters.get(user_pk, ()):
+                    waiter.set()
+
+    def _watch(self):
+        path = connection = None
+        while True:
+            try:
+                if settings.CHANGES_DATABASE != path:
+                    path = settings.CHANGES_DATABASE
+                    connection = self._connect(path)
+                    version = connection.execute('PRAGMA data_version').fetchone()[0]
+                    last_id = connection.execute('SELECT COALESCE(MAX(id), 0) FROM change').fetchone()[0]
+                    # Events appended before may not have been seen by clients already waiting
+                    with self._lock:
+                        user_pks = list(self._waiters)
+                    self._wake(user_pks)
+                current = connection.execute('PRAGMA data_version').fetchone()[0]
+                if current != version:
+                    # One query per commit of other connections, however many clients are waiting
+                    rows = connection.execute('SELECT user_id, MAX(id) FROM change WHERE id > ? GROUP BY user_id',
+                                              (last_id,)).fetchall()
+                    if rows:
+                        last_id = max(row[1] for row in rows)
+                        self._wake(row[0] for row in rows)
+                    version = current
+            except Exception:
+                logger.exception('Watching changes in %s failed', path)
+                # Connects again and wakes every client on the next round, so none misses events
+                path = None
+            time.sleep(settings.CHANGES_WATCH_INTERVAL)
+
+    def _start_watcher(self):
+        with self._lock:
+            # Started again if it died, clients of this process would only wake up on their timeouts otherwise
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=self._watch, name='change-log-watcher', daemon=True)
+                self._watcher.start()
+
+    @contextlib.contextmanager
+    def listening(self):
+        """
+        Holds one of `CHANGES_MAX_LISTENERS` places of clients waiting for events in this process
+        :raise TooManyListeners: if all of them are taken
+        """
+        with self._lock:
+            if self._listeners >= settings.CHANGES_MAX_LISTENERS:
+                raise TooManyListeners()
+            self._listeners += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._listeners -= 1
+
+    def wait(self, user_pk, since, timeout):
+        """
+        Waits up to `timeout` seconds for events of the user after `since`
+        :return: list of events, empty if nothing has happened
+        """
+        self._start_watcher()
+        deadline = time.time() + timeout
+        waiter = threading.Event()
+        with self._lock:
+            self._waiters.setdefault(user_pk, []).append(waiter)
+        try:
+            while True:
+                # Reading after the waiter is added and cleared, so no event is missed before waiting
+                events = self.read(user_pk, since)
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events
+                waiter.wait(remaining)
+                waiter.clear()
+        finally:
+            with self._lock:
+                waiters = self._waiters[user_pk]
+                waiters.remove(waiter)
+                if not waiters:
+                    del self._waiters[user_pk]
+
+
+change_log = ChangeLog()
@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from todo.models import Todo, ArchivedTodo
+
+
+class Command(BaseCommand):
+    help = 'Moves done todos into the archive in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, required=True, dest='days',
+                            help='Archive done todos with a deadline more than this number of days ago')
+        parser.add_argument('--include-undated', action='store_true', default=False,
+                            help='Also archive done todos without a deadline')
+        parser.add_argument('--batch-size', type=int, default=500, help='Todos moved in one transaction')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches to let other writers in')
+
+    def handle(self, *args, **options):
+        condition = Q(deadline__lt=timezone.now() - timezone.timedelta(days=options['days']))
+        if options['include_undated']:
+            condition |= Q(deadline__isnull=True)
+
+        total = 0
+        for alias in settings.SHARDS:
+            todos = Todo.objects.using(alias).filter(condition, is_done=True)
+            while True:
+                archived = ArchivedTodo.archive_batch(todos, options['batch_size'])
+                if not archived:
+                    break
+                total += archived
+                self.stdout.write('{0}: {1} todos archived'.format(alias, archived))
+                time.sleep(options['pause'])
+        self.stdout.write('Done, {0} todos archived'.format(total))
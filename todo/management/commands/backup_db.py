@@ -0,0 +1,116 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from todo.backup import MAX_RESTARTS, SnapshotStore, TooManyRestarts, WriteLockProbe, export_user, import_user
+from todo.metrics import percentile
+
+
+class Command(BaseCommand):
+    help = ('Backs up SQLite databases of the site while it is running: incremental snapshots of whole databases '
+            'and their restore, or export and import of the rows of one user')
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('snapshot', 'list', 'restore', 'prune', 'export', 'import'))
+        parser.add_argument('target', nargs='?',
+                            help='Snapshot id to restore, or file to export a user to or import from')
+        parser.add_argument('--database', nargs='+', dest='aliases',
+                            help='Databases to snapshot, all shards by default')
+        parser.add_argument('--store', help='Snapshot file, BACKUP_DATABASE by default')
+        parser.add_argument('--pages', type=int, default=256,
+                            help='Pages copied in one step, writers wait for at most one step')
+        parser.add_argument('--sleep', type=float, default=0.01, help='Seconds between steps')
+        parser.add_argument('--max-restarts', type=int, default=MAX_RESTARTS,
+                            help='Times a snapshot may start over because of writes before it fails')
+        parser.add_argument('--keep', type=int, default=7, help='Snapshots of every database kept by `prune`')
+        parser.add_argument('--user', type=int, help='Id of the user to export')
+        parser.add_argument('--measure', action='store_true', default=False,
+                            help='Report how long writers wait for their lock before and during the snapshot')
+
+    def _path(self, alias):
+        database = settings.DATABASES.get(alias)
+        if database is None or database['ENGINE'] != 'django.db.backends.sqlite3':
+            raise CommandError('Database `{0}` is not a configured SQLite database'.format(alias))
+        return database['NAME']
+
+    def _report_waits(self, name, samples):
+        self.stdout.write('  write lock wait {0}: p50 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms '
+                          '({4} samples)'.format(name, percentile(samples, 0.5) * 1000,
+                                                 percentile(samples, 0.99) * 1000,
+                                                 (samples[-1] if samples else 0) * 1000, len(samples)))
+
+    def _snapshot(self, store, options):
+        for alias in options['aliases'] or settings.SHARDS:
+            path = self._path(alias)
+            if options['measure']:
+                baseline = WriteLockProbe(path)
+                baseline.start()
+                time.sleep(1)
+                self._report_waits('before', baseline.stop())
+                probe = WriteLockProbe(path)
+                probe.start()
+
+            start = time.perf_counter()
+            try:
+                snapshot = store.take(alias, path, options['pages'], options['sleep'],
+                                      max_restarts=options['max_restarts'])
+            except TooManyRestarts as e:
+                if options['measure']:
+                    probe.stop()
+                raise CommandError(e)
+            elapsed = time.perf_counter() - start
+            if options['measure']:
+                self._report_waits('during', probe.stop())
+            self.stdout.write('Snapshot {0} of {1}: {2} pages of {3} bytes, {4} new, in {5:.1f} s'.format(
+                snapshot['id'], alias, snapshot['page_count'], snapshot['page_size'], snapshot['new_pages'],
+                elapsed))
+
+    def handle(self, *args, **options):
+        action, target = options['action'], options['target']
+
+        if action == 'export':
+            if options['user'] is None or target is None:
+                raise CommandError('Usage: backup_db export FILE --user ID')
+            with open(target, 'w') as f:
+                count = export_user(options['user'], f)
+            self.stdout.write('{0} rows of user {1} exported to {2}'.format(count, options['user'], target))
+            return
+        if action == 'import':
+            if target is None:
+                raise CommandError('Usage: backup_db import FILE')
+            try:
+                with open(target) as f:
+                    user_pk, count = import_user(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(e)
+            self.stdout.write('{0} rows of user {1} restored from {2}'.format(count, user_pk, target))
+            return
+
+        if action in ('snapshot', 'restore') and not hasattr(sqlite3.Connection, 'backup'):
+            raise CommandError('The online backup API needs Python 3.7 or newer')
+        store = SnapshotStore(options['store'] or settings.BACKUP_DATABASE)
+        try:
+            if action == 'snapshot':
+                self._snapshot(store, options)
+            elif action == 'list':
+                self.stdout.write('{0:>6} {1:<10} {2:<20} {3:>10} {4:>10}'.format(
+                    'id', 'database', 'created', 'pages', 'new pages'))
+                for snapshot_id, alias, created, page_size, page_count, new_pages in store.snapshots():
+                    created = timezone.localtime(timezone.datetime.fromtimestamp(created, timezone.utc))
+                    self.stdout.write('{0:>6} {1:<10} {2:<20} {3:>10} {4:>10}'.format(
+                        snapshot_id, alias, created.strftime(settings.DATETIME_FORMAT), page_count, new_pages))
+            elif action == 'restore':
+                try:
+                    snapshot_id = int(target)
+                    alias = store.get_alias(snapshot_id)
+                except (TypeError, ValueError, KeyError):
+                    raise CommandError('Usage: backup_db restore SNAPSHOT_ID, see `backup_db list`')
+                store.restore(snapshot_id, self._path(alias), options['pages'], options['sleep'])
+                self.stdout.write('Snapshot {0} restored into {1}'.format(snapshot_id, alias))
+            elif action == 'prune':
+                self.stdout.write('{0} snapshots deleted'.format(store.prune(options['keep'])))
+        finally:
+            store.close()
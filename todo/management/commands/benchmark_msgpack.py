@@ -0,0 +1,59 @@
+import json
+import time
+
+import msgpack
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+
+from todo.renderers import MessagePackRenderer
+
+
+class Command(BaseCommand):
+    help = 'Compares payload size and encode/decode time of JSON and MessagePack todo lists'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100, help='Todos in the list, PAGE_SIZE is 100')
+        parser.add_argument('--repeat', type=int, default=200)
+
+    def _page(self, rows, native_datetimes):
+        start = timezone.now()
+        results = []
+        for i in range(rows):
+            deadline = start + timezone.timedelta(hours=i)
+            results.append({
+                'id': i + 1,
+                'category': i % 7 + 1,
+                'tags': list(range(1, i % 4 + 1)),
+                'text': 'Todo number {0}'.format(i),
+                'is_done': bool(i % 3),
+                'deadline': deadline if native_datetimes else deadline.strftime(settings.DATETIME_FORMAT),
+            })
+        return {'count': rows, 'next': None, 'previous': None, 'results': results}
+
+    def _time(self, function, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - start) / repeat * 10 ** 6
+
+    def handle(self, *args, **options):
+        repeat = options['repeat']
+        json_page = self._page(options['rows'], False)
+        native_page = self._page(options['rows'], True)
+        json_renderer, msgpack_renderer = JSONRenderer(), MessagePackRenderer()
+        formats = (
+            ('json', lambda: json_renderer.render(json_page, 'application/json'),
+             lambda payload: json.loads(payload.decode('utf-8'))),
+            ('msgpack', lambda: msgpack_renderer.render(native_page, 'application/msgpack'),
+             lambda payload: msgpack.unpackb(payload, timestamp=3)),
+            ('msgpack columnar', lambda: msgpack_renderer.render(native_page, 'application/msgpack; layout=columnar'),
+             lambda payload: msgpack.unpackb(payload, timestamp=3)),
+        )
+
+        self.stdout.write('{0:<18} {1:>8} {2:>12} {3:>12}'.format('format', 'bytes', 'encode, us', 'decode, us'))
+        for name, encode, decode in formats:
+            payload = encode()
+            self.stdout.write('{0:<18} {1:>8} {2:>12.1f} {3:>12.1f}'.format(
+                name, len(payload), self._time(encode, repeat), self._time(lambda: decode(payload), repeat)))
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from rest_framework.throttling import UserRateThrottle
+
+from todo.throttling import UserSlidingWindowThrottle
+
+
+class Command(BaseCommand):
+    help = 'Measures the overhead of throttling per request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=2000, help='Requests to time')
+        parser.add_argument('--history', type=int, nargs='+', default=[0, 1000, 10000],
+                            help='Requests already made in the window before timing')
+
+    def _time(self, throttle_class, request, history, requests):
+        rate = '{0}/day'.format(history + requests + 1)
+        throttle = type('Benchmark' + throttle_class.__name__, (throttle_class,), {'rate': rate})()
+        for _ in range(history):
+            throttle.allow_request(request, None)
+        start = time.perf_counter()
+        for _ in range(requests):
+            throttle.allow_request(request, None)
+        return (time.perf_counter() - start) / requests * 10 ** 6
+
+    def handle(self, *args, **options):
+        request = Request(APIRequestFactory().get('/api/todo/'))
+        user = get_user_model()(pk=1, username='benchmark')
+        directory = tempfile.mkdtemp()
+
+        self.stdout.write('{0:>10} {1:>18} {2:>18}'.format('history', 'stock, us/req', 'sliding, us/req'))
+        for i, history in enumerate(options['history']):
+            # Fresh user and counters file for every run
+            request.user = user
+            user.pk = i + 1
+            UserRateThrottle.cache.clear()
+            path = os.path.join(directory, 'throttle-{0}.sqlite3'.format(i))
+            with override_settings(THROTTLE_DATABASE=path):
+                stock = self._time(UserRateThrottle, request, history, options['requests'])
+                sliding = self._time(UserSlidingWindowThrottle, request, history, options['requests'])
+            self.stdout.write('{0:>10} {1:>18.1f} {2:>18.1f}'.format(history, stock, sliding))
+        shutil.rmtree(directory)
@@ -0,0 +1,58 @@
+import time
+
+import pytz
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from todo.serializers import DateTimeTzAwareField, ZoneTransitions
+
+
+class Command(BaseCommand):
+    help = 'Compares per-row and batched conversion of deadlines spanning DST transitions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000)
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--zones', nargs='+',
+                            default=['UTC', 'Europe/Moscow', 'Europe/London', 'America/New_York', 'Australia/Sydney'])
+
+    def _time(self, function, repeat):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            function()
+        return (time.perf_counter() - start) / repeat * 10 ** 6
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        # Every 53 minutes from a week before the March transitions, so a 10k page spans both DST changes of a year
+        start = timezone.make_aware(timezone.datetime(2016, 3, 6))
+        deadlines = [start + timezone.timedelta(minutes=53 * i) for i in range(rows)]
+        field = DateTimeTzAwareField()
+
+        # Times are for the whole list, "field" columns include formatting
+        self.stdout.write('{0:<20} {1:>14} {2:>14} {3:>14} {4:>18}'.format(
+            'zone', 'localtime, us', 'batched, us', 'field, us', 'field batched, us'))
+        for name in options['zones']:
+            tz = pytz.timezone(name)
+            with timezone.override(tz):
+                expected = [field.to_representation(deadline) for deadline in deadlines]
+                ZoneTransitions._cache.clear()
+
+                def batched():
+                    return ZoneTransitions.get(timezone.get_current_timezone()).localize_many(deadlines)
+
+                def batched_format():
+                    field.localized = batched()
+                    try:
+                        return [field.to_representation(deadline) for deadline in deadlines]
+                    finally:
+                        field.localized = None
+
+                if batched_format() != expected:
+                    raise CommandError('Batched conversion differs from localtime() for {0}'.format(name))
+                self.stdout.write('{0:<20} {1:>14.0f} {2:>14.0f} {3:>14.0f} {4:>18.0f}'.format(
+                    name,
+                    self._time(lambda: [timezone.localtime(deadline) for deadline in deadlines], repeat),
+                    self._time(batched, repeat),
+                    self._time(lambda: [field.to_representation(deadline) for deadline in deadlines], repeat),
+                    self._time(batched_format, repeat)))
@@ -0,0 +1,195 @@
+import http.client
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import WSGIServer, WSGIRequestHandler
+from django.core.signals import got_request_exception
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+from django.db.utils import OperationalError
+from django.test import override_settings
+
+from todo.metrics import percentile
+from todo.models import Profile, Todo
+from todo.throttling import SlidingWindowThrottleMixin
+
+
+class LoadTestServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = ('Serves mytodo.wsgi.application from forked workers on a temporary database and measures '
+            'throughput, latency and errors of simulated users as concurrency grows')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 5, 10, 25, 50],
+                            help='Simultaneous clients of each step')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds of each step')
+        parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of creates and updates')
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--todos', type=int, default=20, help='Todos every user starts with')
+        parser.add_argument('--workers', type=int, default=4, help='Server processes')
+        parser.add_argument('--throttle', action='store_true',
+                            help='Keep DEFAULT_THROTTLE_RATES, otherwise simulated users are never throttled')
+
+    def _seed(self, users, todos):
+        """
+        :return: list of (token, list of todo ids)
+        """
+        result = []
+        with transaction.atomic():
+            for i in range(users):
+                user = get_user_model().objects.create(username='load{0}'.format(i))
+                Profile(user=user).save()
+                ids = [Todo.objects.create(user=user, text='Todo {0}'.format(j)).pk for j in range(todos)]
+                result.append((user.auth_token.key, ids))
+        return result
+
+    def _serve(self, workers):
+        """
+        Loads the application and forks workers sharing the listening socket, like a pre-forking server
+        :return: server, pids of the workers, shared counter of SQLite lock errors
+        """
+        from mytodo.wsgi import application
+
+        locked = multiprocessing.Value('i', 0)
+
+        def count_lock_error(sender, **kwargs):
+            # Sent while the exception is being handled
+            error = sys.exc_info()[1]
+            if isinstance(error, OperationalError) and 'locked' in str(error):
+                with locked.get_lock():
+                    locked.value += 1
+        got_request_exception.connect(count_lock_error, weak=False)
+
+        server = LoadTestServer(('127.0.0.1', 0), QuietRequestHandler)
+        server.set_app(application)
+        connections.close_all()
+        pids = []
+        for _ in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    server.serve_forever()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        return server, pids, locked
+
+    def _client(self, address, users, write_ratio, deadline, results):
+        while time.time() < deadline:
+            token, ids = random.choice(users)
+            detail = '/api/todo/{0}/'.format(random.choice(ids))
+            if random.random() >= write_ratio:
+                method, path, body = 'GET', random.choice(('/api/todo/', '/api/category/', detail)), None
+            elif random.random() < 0.5:
+                method, path, body = 'POST', '/api/todo/', {'text': 'Load test'}
+            else:
+                # Updates of `TodoDetail` are partial
+                method, path, body = 'PUT', detail, {'is_done': random.random() < 0.5}
+            headers = {'Authorization': 'Token {0}'.format(token), 'Accept': 'application/json'}
+            if body is not None:
+                body = json.dumps(body)
+                headers['Content-Type'] = 'application/json'
+
+            start = time.perf_counter()
+            try:
+                connection = http.client.HTTPConnection(*address, timeout=60)
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                content = response.read()
+                connection.close()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status, content = None, b''
+            results.append((time.perf_counter() - start, status))
+            if method == 'POST' and status == 201:
+                ids.append(json.loads(content.decode('utf-8'))['id'])
+
+    def _step(self, address, users, concurrency, options):
+        results = []
+        deadline = time.time() + options['duration']
+        clients = [threading.Thread(target=self._client,
+                                    args=(address, users, options['write_ratio'], deadline, results))
+                   for _ in range(concurrency)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        return results, time.time() - start
+
+    def handle(self, *args, **options):
+        if options['todos'] < 1:
+            raise CommandError('Users need at least one todo to read and update')
+        if len(settings.SHARDS) > 1 or 'replica' in settings.DATABASES:
+            raise CommandError('Load tests run on a single temporary database, '
+                               'unset MYTODO_SHARDS and MYTODO_REPLICA_DB')
+
+        directory = tempfile.mkdtemp()
+        connection = connections[DEFAULT_DB_ALIAS]
+        connection.close()
+        name = connection.settings_dict['NAME']
+        settings.DATABASES[DEFAULT_DB_ALIAS]['NAME'] = connection.settings_dict['NAME'] = \
+            os.path.join(directory, 'db.sqlite3')
+        pids = []
+        try:
+            if not options['throttle']:
+                # Production rates throttle simulated users in seconds, DRF reads them once when throttles are defined
+                SlidingWindowThrottleMixin.THROTTLE_RATES = dict.fromkeys(
+                    settings.REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'])
+            with override_settings(DEBUG=False, ALLOWED_HOSTS=['127.0.0.1'],
+                                   THROTTLE_DATABASE=os.path.join(directory, 'throttle.sqlite3'),
+                                   CHANGES_DATABASE=os.path.join(directory, 'changes.sqlite3'),
+                                   REPLICA_PINS_DATABASE=os.path.join(directory, 'replica_pins.sqlite3'),
+                                   METRICS_DATABASE=os.path.join(directory, 'metrics.sqlite3')):
+                call_command('migrate', verbosity=0, interactive=False)
+                self.stdout.write('Creating {0} users with {1} todos each'.format(options['users'], options['todos']))
+                users = self._seed(options['users'], options['todos'])
+                server, pids, locked = self._serve(options['workers'])
+
+                self.stdout.write('{0:>7} {1:>9} {2:>8} {3:>8} {4:>8} {5:>8} {6:>8} {7:>8} {8:>8} {9:>9}'.format(
+                    'clients', 'requests', 'req/s', 'p50, ms', 'p90, ms', 'p99, ms', 'max, ms',
+                    'errors', 'locked', 'throttled'))
+                for concurrency in options['concurrency']:
+                    locked_before = locked.value
+                    results, elapsed = self._step(server.server_address, users, concurrency, options)
+                    latencies = sorted(latency * 1000 for latency, status in results)
+                    # Requests of seeded users are valid, any client error but throttling is a failure
+                    errors = sum(1 for latency, status in results if status is None or
+                                 (status >= 400 and status != 429))
+                    throttled = sum(1 for latency, status in results if status == 429)
+                    row = '{0:>7} {1:>9} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>8.1f} {6:>8.1f} {7:>7.2f}% {8:>8} {9:>9}'
+                    self.stdout.write(row.format(
+                        concurrency, len(results), len(results) / elapsed,
+                        percentile(latencies, 0.5), percentile(latencies, 0.9), percentile(latencies, 0.99),
+                        latencies[-1] if latencies else 0, errors * 100.0 / max(len(results), 1),
+                        locked.value - locked_before, throttled))
+        finally:
+            for pid in pids:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            if 'THROTTLE_RATES' in vars(SlidingWindowThrottleMixin):
+                del SlidingWindowThrottleMixin.THROTTLE_RATES
+            connection.close()
+            settings.DATABASES[DEFAULT_DB_ALIAS]['NAME'] = connection.settings_dict['NAME'] = name
+            shutil.rmtree(directory)
@@ -0,0 +1,107 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from wsgiref.util import setup_testing_defaults
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+def read_memory():
+    """
+    :return: resident, proportional and private memory of this process in kB, the last two need Linux 4.14+
+    """
+    memory = {}
+    for path, keys in (('/proc/self/smaps_rollup', ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty')),
+                       ('/proc/self/status', ('VmRSS',))):
+        try:
+            with open(path) as f:
+                for line in f:
+                    key, _, value = line.partition(':')
+                    if key in keys:
+                        memory[key] = int(value.split()[0])
+        except IOError:
+            pass
+    return {
+        'rss': memory.get('Rss', memory.get('VmRSS')),
+        'pss': memory.get('Pss'),
+        'private': memory['Private_Clean'] + memory['Private_Dirty'] if 'Private_Dirty' in memory else None,
+    }
+
+
+def probe(started, workers, path, token):
+    """
+    Loads `mytodo.wsgi` like a pre-forking server does, forks workers and times their first requests.
+    Runs in a fresh interpreter and prints the results as JSON
+    """
+    from mytodo.wsgi import application
+    loaded = time.perf_counter()
+
+    environ = {'PATH_INFO': path, 'HTTP_ACCEPT': 'application/json'}
+    if token:
+        environ['HTTP_AUTHORIZATION'] = 'Token {0}'.format(token)
+    setup_testing_defaults(environ)
+
+    def request():
+        start = time.perf_counter()
+        response = application(dict(environ), lambda status, headers, exc_info=None: None)
+        b''.join(response)
+        response.close()
+        return (time.perf_counter() - start) * 1000
+
+    pipes = []
+    for _ in range(workers):
+        read_end, write_end = os.pipe()
+        if os.fork() == 0:
+            os.close(read_end)
+            result = {'first': request(), 'second': request(), 'memory': read_memory()}
+            os.write(write_end, json.dumps(result).encode('utf-8'))
+            os._exit(0)
+        os.close(write_end)
+        pipes.append(read_end)
+
+    results = []
+    for read_end in pipes:
+        with os.fdopen(read_end, 'rb') as f:
+            results.append(json.loads(f.read().decode('utf-8')))
+    for _ in pipes:
+        os.wait()
+    print(json.dumps({'startup': (loaded - started) * 1000, 'master': read_memory(), 'workers': results}))
+
+
+class Command(BaseCommand):
+    help = 'Measures startup time, time to first request and per-worker memory with and without warm-up'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4)
+        parser.add_argument('--path', default='/api/todo/', help='Path of the requests the workers make')
+        parser.add_argument('--token', default='', help='API token to make the requests authenticated')
+
+    def _run(self, warmup, options):
+        code = ('import time; started = time.perf_counter(); '
+                'from todo.management.commands.measure_startup import probe; '
+                'probe(started, {0!r}, {1!r}, {2!r})').format(options['workers'], options['path'], options['token'])
+        env = dict(os.environ, MYTODO_WARMUP='1' if warmup else '0', DJANGO_SETTINGS_MODULE='mytodo.settings')
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env)
+        return json.loads(output.decode('utf-8').splitlines()[-1])
+
+    def _kb(self, value):
+        return '{0:.1f}'.format(value / 1024.0) if value is not None else '-'
+
+    def handle(self, *args, **options):
+        self.stdout.write('{0:<10} {1:>11} {2:>11} {3:>11} {4:>11} {5:>11} {6:>11}'.format(
+            'warm-up', 'startup, ms', 'first, ms', 'second, ms', 'RSS, MB', 'PSS, MB', 'private, MB'))
+        for warmup in (False, True):
+            result = self._run(warmup, options)
+            workers = result['workers']
+            self.stdout.write('{0:<10} {1:>11.1f} {2:>11.1f} {3:>11.1f} {4:>11} {5:>11} {6:>11}'.format(
+                'on' if warmup else 'off',
+                result['startup'],
+                statistics.mean([worker['first'] for worker in workers]),
+                statistics.mean([worker['second'] for worker in workers]),
+                self._kb(statistics.mean([worker['memory']['rss'] for worker in workers])),
+                self._kb(statistics.mean([worker['memory']['pss'] or 0 for worker in workers]) or None),
+                self._kb(statistics.mean([worker['memory']['private'] or 0 for worker in workers]) or None)))
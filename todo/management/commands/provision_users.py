@@ -0,0 +1,68 @@
+import csv
+import sys
+import time
+
+import pytz
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from todo.provisioning import MAX_BATCH_SIZE, USER_FIELDS, provision_batch
+
+
+class Command(BaseCommand):
+    help = ('Creates users from a CSV export of a directory with their profiles and API tokens, '
+            'users that exist are updated in place')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='CSV file with a header of `username` and optionally {0} and `timezone`, '
+                                         '`-` for standard input'.format(', '.join(USER_FIELDS)))
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users provisioned in one transaction, at most {0}'.format(MAX_BATCH_SIZE))
+        parser.add_argument('--timezone', help='Time zone of rows without one, new users get TIME_ZONE otherwise')
+
+    def read_entries(self, f, default_timezone):
+        """
+        :return: list of entries for `provision_batch`, checked before anything is written
+        """
+        username_field = get_user_model()._meta.get_field('username')
+        reader = csv.DictReader(f)
+        if 'username' not in (reader.fieldnames or ()):
+            raise CommandError('The first line must be a header with a `username` column')
+        entries = []
+        for line, row in enumerate(reader, 2):
+            username = (row.get('username') or '').strip()
+            try:
+                username_field.clean(username, None)
+            except ValidationError as e:
+                raise CommandError('Line {0}: invalid username `{1}`, {2}'.format(line, username, ' '.join(e.messages)))
+            entry = {field: row[field] or '' for field in USER_FIELDS if field in row}
+            entry['username'] = username
+            entry['timezone'] = row.get('timezone') or default_timezone
+            if entry['timezone'] is not None and entry['timezone'] not in pytz.all_timezones_set:
+                raise CommandError('Line {0}: unknown time zone `{1}`'.format(line, entry['timezone']))
+            entries.append(entry)
+        return entries
+
+    def handle(self, *args, **options):
+        if not 1 <= options['batch_size'] <= MAX_BATCH_SIZE:
+            raise CommandError('Batch size must be between 1 and {0}'.format(MAX_BATCH_SIZE))
+        if options['file'] == '-':
+            entries = self.read_entries(sys.stdin, options['timezone'])
+        else:
+            with open(options['file'], newline='') as f:
+                entries = self.read_entries(f, options['timezone'])
+
+        start = time.perf_counter()
+        created = updated = 0
+        batch_size = options['batch_size']
+        for i in range(0, len(entries), batch_size):
+            batch_created, batch_updated = provision_batch(entries[i:i + batch_size])
+            created += batch_created
+            updated += batch_updated
+            done, elapsed = min(i + batch_size, len(entries)), time.perf_counter() - start
+            self.stdout.write('{0} of {1} users, {2:.0f} users/s'.format(
+                done, len(entries), done / elapsed if elapsed else 0))
+        elapsed = time.perf_counter() - start
+        self.stdout.write('Done, {0} users created, {1} updated in {2:.1f} s ({3:.0f} users/s)'.format(
+            created, updated, elapsed, len(entries) / elapsed if elapsed else 0))
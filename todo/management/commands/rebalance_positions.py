@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.db.models.functions import Length
+
+from todo.models import Todo
+
+
+class Command(BaseCommand):
+    help = 'Respreads positions of todos in categories whose positions got long from moves into the same gap'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--longer-than', type=int, default=None, dest='length',
+                            help='Rebalance categories with a longer position, POSITION_REBALANCE_LENGTH by default')
+
+    def handle(self, *args, **options):
+        length = options['length'] if options['length'] is not None else settings.POSITION_REBALANCE_LENGTH
+        total = 0
+        for alias in settings.SHARDS:
+            category_pks = (Todo.objects.using(alias).order_by().values('category_id')
+                            .annotate(length=Max(Length('position'))).filter(length__gt=length)
+                            .values_list('category_id', flat=True))
+            for category_pk in category_pks:
+                updated = Todo.rebalance_positions(category_pk, alias)
+                total += updated
+                self.stdout.write('{0}: category {1}, {2} todos updated'.format(alias, category_pk, updated))
+        self.stdout.write('Done, {0} todos updated'.format(total))
@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from todo.models import UserShard
+from todo.sharding import move_users, plan_rebalance
+
+
+class Command(BaseCommand):
+    help = 'Moves users between shards while the site is running'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, nargs='+', dest='users',
+                            help='Ids of users to move, all users are evened out between shards by default')
+        parser.add_argument('--to', dest='target', help='Shard alias to move the users to')
+        parser.add_argument('--grace', type=float, default=None,
+                            help='Seconds to wait between steps of a move, SHARD_CACHE_SECONDS by default')
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Users moved together, their writes are rejected until the whole batch is copied')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only print the planned moves')
+
+    def handle(self, *args, **options):
+        if len(settings.SHARDS) == 1:
+            raise CommandError('Sharding is not configured, set MYTODO_SHARDS')
+        if options['batch_size'] < 1:
+            raise CommandError('`--batch-size` must be positive')
+
+        if options['users']:
+            if options['target'] not in settings.SHARDS:
+                raise CommandError('`--to` must be one of: {0}'.format(', '.join(settings.SHARDS)))
+            moves = [(user_pk, UserShard.get_alias(user_pk), options['target']) for user_pk in options['users']]
+        else:
+            user_pks = get_user_model().objects.order_by('pk').values_list('pk', flat=True)
+            moves = plan_rebalance(user_pks)
+
+        if options['dry_run']:
+            for user_pk, source, target in moves:
+                self.stdout.write('User {0}: {1} -> {2}'.format(user_pk, source, target))
+            self.stdout.write('{0} users to move'.format(len(moves)))
+            return
+
+        # Users of a batch wait through the grace periods together
+        for i in range(0, len(moves), options['batch_size']):
+            batch = [(user_pk, target) for user_pk, source, target in moves[i:i + options['batch_size']]]
+            for user_pk, source, target in move_users(batch, options['grace']):
+                self.stdout.write('User {0} moved from {1} to {2}'.format(user_pk, source, target))
+        self.stdout.write('Done')
@@ -0,0 +1,42 @@
+import sqlite3
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from todo.routers import REPLICA_DB_ALIAS
+
+
+def copy_sqlite_database(source_path, target_path):
+    """
+    Makes a consistent copy of a live SQLite database with the online backup API
+
+    The replica is written in place through SQLite, so connections workers already hold see the new data;
+    a file swapped in beside them would leave them reading the old one
+    """
+    source = sqlite3.connect(source_path)
+    try:
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target)
+        finally:
+            target.close()
+    finally:
+        source.close()
+
+
+class Command(BaseCommand):
+    help = 'Copies the primary database into the read replica'
+
+    def handle(self, *args, **options):
+        if not hasattr(sqlite3.Connection, 'backup'):
+            raise CommandError('The online backup API needs Python 3.7 or newer')
+        databases = settings.DATABASES
+        if REPLICA_DB_ALIAS not in databases:
+            raise CommandError('Replica database is not configured, set MYTODO_REPLICA_DB')
+        for alias in (DEFAULT_DB_ALIAS, REPLICA_DB_ALIAS):
+            if databases[alias]['ENGINE'] != 'django.db.backends.sqlite3':
+                raise CommandError('Database `{0}` is not SQLite'.format(alias))
+
+        copy_sqlite_database(databases[DEFAULT_DB_ALIAS]['NAME'], databases[REPLICA_DB_ALIAS]['NAME'])
+        self.stdout.write('Replica is in sync with the primary')
@@ -0,0 +1,252 @@
+import atexit
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db.backends import utils
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'mytodo_request_duration_seconds': ('histogram', 'Time from the first middleware to the response',
+                                        LATENCY_BUCKETS),
+    'mytodo_request_queries': ('histogram', 'SQL queries executed by a request', QUERY_BUCKETS),
+    'mytodo_responses_total': ('counter', 'Responses by view and status code', None),
+    'mytodo_cache_requests_total': ('counter', 'Cache lookups by cache and result', None),
+    'mytodo_throttled_requests_total': ('counter', 'Requests rejected by throttles', None),
+}
+
+
+# Rows of processes that have exited are summed up under this process
+RETIRED = 'retired'
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def percentile(values, fraction):
+    """
+    :param values: sorted list
+    """
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+class Metrics(object):
+    """
+    Counters and histograms of this process, kept in a dict and flushed at most every `METRICS_FLUSH_SECONDS`
+    into a SQLite file (`METRICS_DATABASE`) shared by workers, where every process owns its rows
+
+    Histograms are stored as per-bucket counters and made cumulative when exposed. Rows of processes
+    that have exited are folded into the rows of `RETIRED` when metrics are collected, so totals never drop
+    while the table only has rows of running processes
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._reset()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+        atexit.register(self.flush, force=True)
+
+    def _reset(self):
+        # Workers forked after metrics were recorded start from zero under their own id
+        self._values = {}
+        self._pid = os.getpid()
+        self._process = uuid.uuid4().hex
+        self._flushed = time.time()
+
+    def _connect(self, path):
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=OFF')
+        connection.execute('CREATE TABLE IF NOT EXISTS metric ('
+                           'process TEXT NOT NULL, '
+                           'name TEXT NOT NULL, '
+                           'labels TEXT NOT NULL, '
+                           'value REAL NOT NULL, '
+                           'PRIMARY KEY (process, name, labels)'
+                           ') WITHOUT ROWID')
+        connection.execute('CREATE TABLE IF NOT EXISTS process ('
+                           'process TEXT PRIMARY KEY, '
+                           'pid INTEGER NOT NULL'
+                           ') WITHOUT ROWID')
+        return connection
+
+    @property
+    def connection(self):
+        path = settings.METRICS_DATABASE
+        if getattr(self._local, 'path', None) != path:
+            self._local.connection = self._connect(path)
+            self._local.path = path
+        return self._local.connection
+
+    def inc(self, name, labels=(), value=1):
+        """
+        :param labels: tuple of (name, value) pairs
+        """
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        buckets = METRICS[name][2]
+        index = bisect.bisect_left(buckets, value)
+        bound = str(buckets[index]) if index < len(buckets) else '+Inf'
+        with self._lock:
+            for key, amount in (((name + '_bucket', labels + (('le', bound),)), 1),
+                                ((name + '_sum', labels), value),
+                                ((name + '_count', labels), 1)):
+                self._values[key] = self._values.get(key, 0) + amount
+
+    def count_cache_lookup(self, cache, hit):
+        self.inc('mytodo_cache_requests_total', (('cache', cache), ('result', 'hit' if hit else 'miss')))
+
+    def flush(self, force=False):
+        if os.getpid() != self._pid:
+            self._reset()
+        now = time.time()
+        if not force and now - self._flushed < settings.METRICS_FLUSH_SECONDS:
+            return
+        with self._lock:
+            self._flushed = now
+            rows = [(self._process, name, json.dumps(labels), value) for (name, labels), value in self._values.items()]
+        if not rows:
+            return
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.executemany('INSERT OR REPLACE INTO metric (process, name, labels, value) '
+                                   'VALUES (?, ?, ?, ?)', rows)
+            connection.execute('INSERT OR REPLACE INTO process (process, pid) VALUES (?, ?)',
+                               (self._process, self._pid))
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+
+    def _retire(self, connection):
+        """
+        Folds rows of processes that have exited into the rows of `RETIRED`
+        """
+        processes = connection.execute('SELECT DISTINCT metric.process, process.pid FROM metric '
+                                       'LEFT JOIN process ON process.process = metric.process '
+                                       'WHERE metric.process != ?', (RETIRED,)).fetchall()
+        # Rows without a process were flushed before processes were recorded
+        dead = [process for process, pid in processes if pid is None or not is_alive(pid)]
+        if not dead:
+            return
+        placeholders = ', '.join('?' * len(dead))
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            # Rows folded by another worker meanwhile are gone and add nothing
+            connection.execute('INSERT OR REPLACE INTO metric (process, name, labels, value) '
+                               'SELECT ?, name, labels, SUM(value) FROM metric WHERE process IN (?, {0}) '
+                               'GROUP BY name, labels'.format(placeholders), [RETIRED, RETIRED] + dead)
+            connection.execute('DELETE FROM metric WHERE process IN ({0})'.format(placeholders), dead)
+            connection.execute('DELETE FROM process WHERE process IN ({0})'.format(placeholders), dead)
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+
+    def collect(self):
+        """
+        :return: dict of (name, labels) to the sum over all processes
+        """
+        self.flush(force=True)
+        connection = self.connection
+        self._retire(connection)
+        rows = connection.execute('SELECT name, labels, SUM(value) FROM metric GROUP BY name, labels')
+        return {(name, tuple(tuple(pair) for pair in json.loads(labels))): value for name, labels, value in rows}
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+        self.connection.execute('DELETE FROM metric')
+        self.connection.execute('DELETE FROM process')
+
+    @staticmethod
+    def _format(name, labels, value):
+        if labels:
+            name += '{' + ','.join('{0}="{1}"'.format(key, str(label).replace('\\', r'\\').replace('"', r'\"'))
+                                   for key, label in labels) + '}'
+        return '{0} {1}\n'.format(name, repr(float(value)))
+
+    def exposition(self):
+        """
+        :return: all metrics in the Prometheus text format
+        """
+        values = self.collect()
+        lines = []
+        for name in sorted(METRICS):
+            kind, help_text, buckets = METRICS[name]
+            lines.append('# HELP {0} {1}\n# TYPE {0} {2}\n'.format(name, help_text, kind))
+            if kind == 'counter':
+                lines.extend(self._format(name, labels, value)
+                             for (series, labels), value in sorted(values.items()) if series == name)
+                continue
+            for (series, labels), count in sorted(values.items()):
+                if series != name + '_count':
+                    continue
+                total = 0
+                for bound in [str(bound) for bound in buckets] + ['+Inf']:
+                    total += values.get((name + '_bucket', labels + (('le', bound),)), 0)
+                    lines.append(self._format(name + '_bucket', labels + (('le', bound),), total))
+                lines.append(self._format(name + '_sum', labels, values.get((name + '_sum', labels), 0)))
+                lines.append(self._format(name + '_count', labels, count))
+        return ''.join(lines)
+
+    # SQL queries are counted per thread by the cursors of `CountingCursorWrapper`
+    def reset_query_count(self):
+        self._local.queries = 0
+
+    def count_query(self):
+        self._local.queries = getattr(self._local, 'queries', 0) + 1
+
+    def query_count(self):
+        return getattr(self._local, 'queries', 0)
+
+
+metrics = Metrics()
+
+
+class QueryCountingMixin(object):
+    def execute(self, sql, params=None):
+        metrics.count_query()
+        return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        metrics.count_query()
+        return super().executemany(sql, param_list)
+
+
+class CountingCursorWrapper(QueryCountingMixin, utils.CursorWrapper):
+    pass
+
+
+class CountingCursorDebugWrapper(QueryCountingMixin, utils.CursorDebugWrapper):
+    pass
+
+
+def count_queries(connection):
+    """
+    Makes cursors of the connection count queries, without the cost of logging them
+    """
+    connection.make_cursor = lambda cursor: CountingCursorWrapper(cursor, connection)
+    connection.make_debug_cursor = lambda cursor: CountingCursorDebugWrapper(cursor, connection)
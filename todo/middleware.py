@@ -1,5 +1,9 @@
+import time
+
 from django.utils import timezone
 
+from .metrics import metrics
+
 
 class TimezoneMiddleware(object):
     def process_request(self, request):
@@ -8,4 +12,27 @@ class TimezoneMiddleware(object):
             if tz:
                 timezone.activate(tz)
             else:
-                timezone.deactivate()
\ No newline at end of file
+                timezone.deactivate()
+
+
+class MetricsMiddleware(object):
+    """
+    Records latency, SQL query count and status of every request by view, should be the first middleware
+    """
+    def process_request(self, request):
+        request.metrics_started = time.perf_counter()
+        metrics.reset_query_count()
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view = getattr(view_func, 'cls', view_func).__name__
+
+    def process_response(self, request, response):
+        started = getattr(request, 'metrics_started', None)
+        if started is not None:
+            view = getattr(request, 'metrics_view', 'none')
+            metrics.observe('mytodo_request_duration_seconds', time.perf_counter() - started,
+                            (('view', view), ('method', request.method)))
+            metrics.observe('mytodo_request_queries', metrics.query_count(), (('view', view),))
+            metrics.inc('mytodo_responses_total', (('view', view), ('status', str(response.status_code))))
+            metrics.flush()
+        return response
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.6 on 2026-10-19 20:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+from todo import ranking
+
+
+def set_positions(apps, schema_editor):
+    # Todos keep the order they were listed in, by deadline
+    Todo = apps.get_model('todo', 'Todo')
+    todos = Todo.objects.using(schema_editor.connection.alias)
+    for category_id in todos.order_by().values_list('category_id', flat=True).distinct():
+        pks = list(todos.filter(category_id=category_id).order_by('deadline', 'pk').values_list('pk', flat=True))
+        for pk, position in zip(pks, ranking.spread(len(pks))):
+            todos.filter(pk=pk).update(position=position)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('todo', '0012_requestprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='archivedtodo',
+            name='position',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='todo',
+            name='position',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AlterIndexTogether(
+            name='todo',
+            index_together=set([('user', 'category', 'position')]),
+        ),
+        migrations.RunPython(set_positions, migrations.RunPython.noop),
+    ]
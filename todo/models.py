@@ -1,14 +1,24 @@
+import json
+import threading
+
+from django.core.cache import cache
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db import models
+from django.db import models, transaction, connections, DEFAULT_DB_ALIAS, IntegrityError
 from django.contrib.auth.models import User
 from django.utils.html import format_html
 from django.conf import settings
-from django.db.models.signals import post_save, post_delete, pre_delete
+from django.db.backends.signals import connection_created
+from django.db.models.functions import Concat, Length
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save, m2m_changed
 from django.dispatch import receiver
-# from django.utils import timezone
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 from timezone_field.fields import TimeZoneField
 
+from .changes import change_log
+from .metrics import metrics, count_queries
+from . import ranking
+
 
 def validate_color(value):
     try:
@@ -17,16 +27,185 @@ def validate_color(value):
         raise ValidationError('{0} is not a hex color!'.format(value))
 
 
+class ShardedQuerySet(models.QuerySet):
+    def for_user(self, user):
+        """
+        Filters by the user and routes the query to the shard of the user
+        """
+        q = self.filter(user=user)
+        q._add_hints(user_pk=user.pk)
+        return q
+
+    def create(self, **kwargs):
+        # Routers can't see whose row is created otherwise
+        if 'user' in kwargs and 'user_pk' not in self._hints:
+            return self.for_user(kwargs['user']).create(**kwargs)
+        return super().create(**kwargs)
+
+
+class UserShard(models.Model):
+    """
+    Directory of the shards users live on, kept on the primary database
+    """
+    user = models.OneToOneField(User, primary_key=True)
+    alias = models.CharField(max_length=64)
+    # Set while `manage.py rebalance_shards` copies the user to another shard, user's writes are rejected
+    moving_to = models.CharField(max_length=64, blank=True)
+
+    @staticmethod
+    def _cache_key(user_pk):
+        return 'todo:user-shard:{0}'.format(user_pk)
+
+    @classmethod
+    def forget(cls, user_pk):
+        cache.delete(cls._cache_key(user_pk))
+
+    @classmethod
+    def _place(cls, user_pk):
+        # Users who already have rows on the primary were created before sharding was enabled
+        if (Profile.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_pk).exists() or
+                Category.objects.using(DEFAULT_DB_ALIAS).filter(user_id=user_pk).exists()):
+            alias = DEFAULT_DB_ALIAS
+        else:
+            alias = settings.SHARDS[user_pk % len(settings.SHARDS)]
+        return cls.objects.get_or_create(user_id=user_pk, defaults={'alias': alias})[0]
+
+    @classmethod
+    def lookup(cls, user_pk):
+        """
+        Finds the shard of the user, placing new users by their id
+        :return: (shard alias, whether the user is being moved)
+        """
+        if len(settings.SHARDS) == 1:
+            return settings.SHARDS[0], False
+        key = cls._cache_key(user_pk)
+        placement = cache.get(key)
+        metrics.count_cache_lookup('user_shard', placement is not None)
+        if placement is None:
+            try:
+                user_shard = cls.objects.get(user_id=user_pk)
+            except ObjectDoesNotExist:
+                user_shard = cls._place(user_pk)
+            placement = (user_shard.alias, bool(user_shard.moving_to))
+            cache.set(key, placement, settings.SHARD_CACHE_SECONDS)
+        return placement
+
+    @classmethod
+    def get_alias(cls, user_pk):
+        return cls.lookup(user_pk)[0]
+
+    @classmethod
+    def is_moving(cls, user_pk):
+        return cls.lookup(user_pk)[1]
+
+
+class ShardSequence(models.Model):
+    """
+    Hands out ids of sharded models in blocks, so they stay unique across shards
+    and users can be moved between shards without changing them
+    """
+    BLOCK_SIZE = 100
+
+    name = models.CharField(max_length=64, primary_key=True)
+    value = models.BigIntegerField()
+
+    _blocks = {}
+    _lock = threading.Lock()
+    # Blocks reserved inside a transaction of the thread, they are shared once it commits
+    _pending = threading.local()
+
+    @classmethod
+    def _reserve_block(cls, model):
+        name = model._meta.label_lower
+        # Archived todos keep their ids
+        id_models = (model, ArchivedTodo) if model is Todo else (model,)
+        while True:
+            try:
+                with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                    if cls.objects.filter(name=name).update(value=models.F('value') + cls.BLOCK_SIZE):
+                        return cls.objects.get(name=name).value - cls.BLOCK_SIZE
+                    start = max(id_model.objects.using(alias).aggregate(models.Max('pk'))['pk__max'] or 0
+                                for id_model in id_models for alias in settings.SHARDS) + 1
+                    cls.objects.create(name=name, value=start + cls.BLOCK_SIZE)
+                    return start
+            except IntegrityError:
+                # Other process has created the sequence first
+                pass
+
+    @classmethod
+    def _allocate_pending(cls, model):
+        """
+        Hands out ids of a block reserved by the open transaction, which other processes get again if it rolls back
+        """
+        blocks = cls._pending.__dict__.setdefault('blocks', {})
+        block = blocks.get(model)
+        # Rolling back the transaction or the savepoint of a reservation drops its commit hook
+        if (block is None or block[0] >= block[1] or
+                not any(func is block[2] for sids, func in connections[DEFAULT_DB_ALIAS].run_on_commit)):
+            start = cls._reserve_block(model)
+            block = [start, start + cls.BLOCK_SIZE, None]
+
+            def share():
+                if blocks.get(model) is block:
+                    del blocks[model]
+                with cls._lock:
+                    next_id, end = cls._blocks.get(model, (0, 0))
+                    if next_id >= end:
+                        cls._blocks[model] = (block[0], block[1])
+
+            block[2] = share
+            blocks[model] = block
+            transaction.on_commit(share, using=DEFAULT_DB_ALIAS)
+        block[0] += 1
+        return block[0] - 1
+
+    @classmethod
+    def allocate_id(cls, model):
+        with cls._lock:
+            next_id, end = cls._blocks.get(model, (0, 0))
+            if next_id < end or not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+                if next_id >= end:
+                    next_id = cls._reserve_block(model)
+                    end = next_id + cls.BLOCK_SIZE
+                cls._blocks[model] = (next_id + 1, end)
+                return next_id
+        return cls._allocate_pending(model)
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, primary_key=True)
     timezone = TimeZoneField(default=settings.TIME_ZONE)
 
+    objects = ShardedQuerySet.as_manager()
+
 
 class Tag(models.Model):
     user = models.ForeignKey(User)
     name = models.CharField(max_length=64, db_index=True)
     color = models.CharField(max_length=6, validators=[validate_color])
 
+    objects = ShardedQuerySet.as_manager()
+
+    def merge_into(self, target):
+        """
+        Moves tag links of all todos to the target tag with set-based statements and deletes this tag
+        """
+        db = self._state.db
+        with transaction.atomic(using=db):
+            events = []
+            for model in (Todo, ArchivedTodo):
+                through = model.tags.through
+                todo_field = model._meta.model_name
+                links = through.objects.using(db).filter(tag=self)
+                if model is Todo:
+                    events = [(self.user_id, 'todo', pk, 'update') for pk in links.values_list(todo_field, flat=True)]
+                # Todos already having the target tag only lose this one
+                tagged = through.objects.using(db).filter(tag=target).values(todo_field)
+                links.filter(**{todo_field + '__in': tagged}).delete()
+                links.update(tag=target)
+            self.delete()
+            transaction.on_commit(lambda: change_log.append_many(events), using=db)
+
     def colored_name(self):
         return format_html('<span style="color: #{};">{}</span>', self.color, self.name)
     colored_name.admin_order_field = 'name'
@@ -44,24 +223,40 @@ class Category(models.Model):
     user = models.ForeignKey(User)
     name = models.CharField(max_length=256, db_index=True)
 
+    objects = ShardedQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
     @classmethod
     def get_or_create_default(cls, user):
-        return cls.objects.get_or_create(user=user, name=cls.DEFAULT_NAME)[0]
+        return cls.objects.for_user(user).get_or_create(user=user, name=cls.DEFAULT_NAME)[0]
 
     @classmethod
     def get_default_category(cls, user):
         try:
-            return cls.objects.get(user=user, name=cls.DEFAULT_NAME)
+            return cls.objects.for_user(user).get(name=cls.DEFAULT_NAME)
         except ObjectDoesNotExist:
             return None
 
+    def merge_into(self, target):
+        """
+        Moves all todos to the end of the target category with set-based statements and deletes this category
+        """
+        db = self._state.db
+        with transaction.atomic(using=db):
+            todos = self.todo_set.using(db)
+            events = [(self.user_id, 'todo', pk, 'update') for pk in todos.values_list('pk', flat=True)]
+            Todo.append_to_category(todos, target)
+            self.archivedtodo_set.using(db).update(category=target)
+            self.delete()
+            Category.delete_default_if_empty(self.user)
+            transaction.on_commit(lambda: change_log.append_many(events), using=db)
+
     @classmethod
     def delete_default_if_empty(cls, user):
         category = cls.get_default_category(user)
-        if category and not category.todo_set.exists():
+        if category and not category.todo_set.exists() and not category.archivedtodo_set.exists():
             category.delete()
 
     class Meta:
@@ -71,12 +266,18 @@ class Category(models.Model):
 
 
 class Todo(models.Model):
+    POSITION_LENGTH = 64
+
     user = models.ForeignKey(User)
     category = models.ForeignKey(Category, blank=True, on_delete=models.DO_NOTHING)
     tags = models.ManyToManyField(Tag, blank=True)
     text = models.CharField(max_length=256, db_index=True)
     is_done = models.BooleanField(default=False, db_index=True)
     deadline = models.DateTimeField(null=True, blank=True, db_index=True)
+    # Rank key of the todo in its category, see `todo.ranking`
+    position = models.CharField(max_length=POSITION_LENGTH, blank=True)
+
+    objects = ShardedQuerySet.as_manager()
 
     def mark_done(self, new_state):
         self.is_done = new_state
@@ -86,21 +287,226 @@ class Todo(models.Model):
         self.category_id = None
         self.save()
 
+    @classmethod
+    def next_position(cls, user, category_id):
+        """
+        :return: position after the last todo of the category
+        """
+        last = cls.objects.for_user(user).filter(category_id=category_id).order_by('-position').values_list(
+            'position', flat=True).first()
+        return ranking.key_between(last or None, None)
+
+    @classmethod
+    def append_to_category(cls, todos, category):
+        """
+        Moves todos of the queryset after the last todo of the category with one statement, keeping their order:
+        their positions get a prefix sorting after the positions there
+        """
+        using = todos.db
+        last = cls.objects.using(using).filter(category=category).order_by('-position').values_list(
+            'position', flat=True).first()
+        prefix = ranking.key_between(last or None, None)
+        longest = todos.aggregate(length=models.Max(Length('position')))['length'] or 0
+        todos.update(category=category, position=Concat(models.Value(prefix), 'position'))
+        if len(prefix) + longest > cls.POSITION_LENGTH:
+            cls.rebalance_positions(category.pk, using)
+
+    def _position_after(self, category_id, after_pk):
+        """
+        :param after_pk: id of the todo to be placed after, None to be placed first
+        :return: position between that todo and the next one or None if there is no room for a key
+        """
+        todos = Todo.objects.using(self._state.db).filter(user_id=self.user_id, category_id=category_id)
+        siblings = todos.exclude(pk=self.pk)
+        low = None
+        if after_pk is not None:
+            low = siblings.get(pk=after_pk).position
+            siblings = siblings.filter(models.Q(position__gt=low) | models.Q(position=low, pk__gt=after_pk))
+        high = siblings.order_by('position', 'pk').values_list('position', flat=True).first()
+        try:
+            position = ranking.key_between(low, high)
+        except ValueError:
+            # Equal positions of todos moved at the same time
+            return None
+        return position if len(position) <= self.POSITION_LENGTH else None
+
+    def move(self, after=None, category=None):
+        """
+        Puts the todo right after another todo, into the category of that todo,
+        or first into the category when `after` is None; only the row of this todo is updated
+        :param category: category to put the todo first into, its own by default
+        """
+        if after is not None:
+            category = after.category
+        elif category is None:
+            category = self.category
+        db = self._state.db
+        with transaction.atomic(using=db):
+            after_pk = None if after is None else after.pk
+            position = self._position_after(category.pk, after_pk)
+            if position is None:
+                Todo.rebalance_positions(category.pk, db)
+                position = self._position_after(category.pk, after_pk)
+            self.category = category
+            self.position = position
+            self._positioned_in = category.pk
+            self.save(update_fields=('category', 'position'))
+
+    @classmethod
+    def rebalance_positions(cls, category_id, using):
+        """
+        Spreads positions of todos of the category evenly over the key space, so keys are short again
+        :return: number of updated todos
+        """
+        with transaction.atomic(using=using):
+            todos = cls.objects.using(using).filter(category_id=category_id).order_by('position', 'pk')
+            rows = list(todos.values_list('pk', 'user_id', 'position'))
+            changed = [(pk, user_pk, position) for (pk, user_pk, old), position
+                       in zip(rows, ranking.spread(len(rows))) if position != old]
+            for pk, user_pk, position in changed:
+                cls.objects.using(using).filter(pk=pk).update(position=position)
+            events = [(user_pk, 'todo', pk, 'update') for pk, user_pk, position in changed]
+            transaction.on_commit(lambda: change_log.append_many(events), using=using)
+        return len(changed)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        todo = super().from_db(db, field_names, values)
+        # Category the position belongs to
+        todo._positioned_in = todo.__dict__.get('category_id')
+        return todo
+
     def save(self, *args, **kwargs):
         if self.category_id is None:
             self.category = Category.get_or_create_default(self.user)
-        elif self.category.user.pk != self.user.pk:
+        elif self.category.user_id != self.user_id:
             raise ValidationError({'category': 'You do not own that category!'})
+        if not self.position or self.category_id != getattr(self, '_positioned_in', self.category_id):
+            # Todos put into another category go last there
+            self.position = self.next_position(self.user, self.category_id)
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = set(kwargs['update_fields']) | {'position'}
         super().save(*args, **kwargs)
+        self._positioned_in = self.category_id
 
     class Meta:
         ordering = ('deadline',)
+        index_together = [('user', 'category', 'position')]
+
+
+class ArchivedTodo(models.Model):
+    """
+    Done todo moved out of `Todo` by `manage.py archive_todos`, keeps the id it had
+    """
+    user = models.ForeignKey(User)
+    category = models.ForeignKey(Category, blank=True, on_delete=models.DO_NOTHING)
+    tags = models.ManyToManyField(Tag, blank=True)
+    text = models.CharField(max_length=256)
+    is_done = models.BooleanField(default=True)
+    deadline = models.DateTimeField(null=True, blank=True, db_index=True)
+    position = models.CharField(max_length=Todo.POSITION_LENGTH, blank=True)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    objects = ShardedQuerySet.as_manager()
+
+    @classmethod
+    def archive_batch(cls, todos, batch_size):
+        """
+        Moves up to `batch_size` todos of the queryset with their tag links into the archive
+        :return: number of archived todos
+        """
+        db = todos.db
+        through = Todo.tags.through
+        archived_through = cls.tags.through
+        with transaction.atomic(using=db):
+            ids = list(todos.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                return 0
+            cls.objects.using(db).bulk_create(
+                cls(id=todo.id, user_id=todo.user_id, category_id=todo.category_id, text=todo.text,
+                    is_done=todo.is_done, deadline=todo.deadline, position=todo.position)
+                for todo in Todo.objects.using(db).filter(pk__in=ids)
+            )
+            archived_through.objects.using(db).bulk_create(
+                archived_through(archivedtodo_id=link.todo_id, tag_id=link.tag_id)
+                for link in through.objects.using(db).filter(todo_id__in=ids)
+            )
+            # Deleting through the ORM would send signals for every todo
+            placeholders = ', '.join(['%s'] * len(ids))
+            with connections[db].cursor() as cursor:
+                cursor.execute('DELETE FROM {0} WHERE todo_id IN ({1})'.format(through._meta.db_table, placeholders),
+                               ids)
+                cursor.execute('DELETE FROM {0} WHERE id IN ({1})'.format(Todo._meta.db_table, placeholders), ids)
+            events = [(user_pk, 'todo', pk, 'archive')
+                      for pk, user_pk in cls.objects.using(db).filter(pk__in=ids).values_list('pk', 'user_id')]
+            transaction.on_commit(lambda: change_log.append_many(events), using=db)
+        return len(ids)
+
+    def restore(self):
+        """
+        Moves the todo back from the archive under the same id
+        :return: restored todo
+        """
+        db = self._state.db
+        with transaction.atomic(using=db):
+            todo = Todo(id=self.id, user_id=self.user_id, category_id=self.category_id, text=self.text,
+                        is_done=self.is_done, deadline=self.deadline, position=self.position)
+            todo.save(force_insert=True, using=db)
+            todo.tags.add(*self.tags.all())
+            self.delete()
+        return todo
+
+    class Meta:
+        ordering = ('deadline',)
+
+
+class RequestProfile(models.Model):
+    """
+    Profile of an API request made by a staff user, kept on the primary database
+    """
+    user = models.ForeignKey(User)
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    method = models.CharField(max_length=8)
+    path = models.TextField()
+    status_code = models.PositiveSmallIntegerField()
+    duration = models.FloatField(help_text='Milliseconds')
+    query_count = models.PositiveIntegerField()
+    sql_duration = models.FloatField(help_text='Milliseconds')
+    # Collapsed stacks with sample counts, for flamegraph.pl or speedscope
+    stacks = models.TextField(blank=True)
+    # JSON list of {"db", "sql", "time"}
+    queries = models.TextField(blank=True)
+
+    @classmethod
+    def record(cls, request, response, profiler):
+        """
+        :param profiler: stopped `todo.profiling.RequestProfiler`
+        """
+        queries = profiler.recorder.queries
+        return cls.objects.create(
+            user=request.user, method=request.method, path=request.get_full_path(),
+            status_code=response.status_code, duration=profiler.duration, query_count=len(queries),
+            sql_duration=sum(query['time'] for query in queries) * 1000,
+            stacks=profiler.sampler.collapsed(), queries=json.dumps(queries, indent=2))
+
+    class Meta:
+        ordering = ('-created',)
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Tag)
+@receiver(pre_save, sender=Todo)
+def allocate_id_across_shards(sender, instance, raw=False, **kwargs):
+    if instance.pk is None and not raw and len(settings.SHARDS) > 1:
+        instance.pk = ShardSequence.allocate_id(sender)
 
 
 @receiver(pre_delete, sender=Category)
 def set_default_category_to_todo_set(sender, instance, **kwargs):
-    for todo in instance.todo_set.all():
+    for todo in instance.todo_set.order_by('position', 'pk'):
         todo.reset_category()
+    if instance.archivedtodo_set.exists():
+        instance.archivedtodo_set.update(category=Category.get_or_create_default(instance.user))
 
 
 @receiver((post_delete, post_save), sender=Todo)
@@ -108,6 +514,42 @@ def delete_default_category_if_empty(sender, instance=None, **kwargs):
     Category.delete_default_if_empty(instance.user)
 
 
+def publish_change(instance, action, using):
+    event = (instance.user_id, instance._meta.model_name, instance.pk, action)
+    transaction.on_commit(lambda: change_log.append(*event), using=using)
+
+
+@receiver(post_save, sender=Todo)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Category)
+def publish_save(sender, instance, created=False, raw=False, using=None, **kwargs):
+    if not raw:
+        publish_change(instance, 'create' if created else 'update', using)
+
+
+@receiver(post_delete, sender=Todo)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Category)
+def publish_delete(sender, instance, using=None, **kwargs):
+    publish_change(instance, 'delete', using)
+
+
+@receiver(m2m_changed, sender=Todo.tags.through)
+def publish_tags_change(sender, instance, action, reverse, pk_set=None, using=None, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        publish_change(instance, 'update', using)
+    elif pk_set:
+        events = [(instance.user_id, 'todo', pk, 'update') for pk in pk_set]
+        transaction.on_commit(lambda: change_log.append_many(events), using=using)
+
+
+@receiver(connection_created)
+def count_connection_queries(sender, connection, **kwargs):
+    count_queries(connection)
+
+
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
 def create_auth_token(sender, instance=None, created=False, **kwargs):
     if created:
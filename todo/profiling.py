@@ -0,0 +1,101 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+from django.db import connections
+
+
+class StackSampler(object):
+    """
+    Samples the stack of a thread every `interval` seconds from a background thread,
+    the result is in the collapsed format read by flamegraph.pl and speedscope
+    """
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = collections.Counter()
+        self._labels = {}
+        self._stopped = threading.Event()
+        self._thread = None
+        self._paths = sorted((os.path.join(path, '') for path in sys.path if path), key=len, reverse=True)
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            for path in self._paths:
+                if filename.startswith(path):
+                    filename = filename[len(path):]
+                    break
+            # Semicolons separate frames in the collapsed format, counts follow the last space
+            label = self._labels[code] = '{0} ({1}:{2})'.format(
+                code.co_name, filename, code.co_firstlineno).replace(';', ',')
+        return label
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def collapsed(self):
+        """
+        :return: one "frame;frame;frame count" line per distinct stack
+        """
+        return ''.join('{0} {1}\n'.format(stack, count) for stack, count in sorted(self.counts.items()))
+
+
+class QueryRecorder(object):
+    """
+    Records SQL and timings of all databases executed by the current thread, like `DEBUG` does
+    """
+    def __init__(self):
+        self._started = {}
+        self.queries = []
+
+    def start(self):
+        for connection in connections.all():
+            self._started[connection.alias] = (connection.force_debug_cursor, len(connection.queries_log))
+            connection.force_debug_cursor = True
+
+    def stop(self):
+        for connection in connections.all():
+            force_debug_cursor, start = self._started.get(connection.alias, (connection.force_debug_cursor, 0))
+            connection.force_debug_cursor = force_debug_cursor
+            self.queries.extend({'db': connection.alias, 'sql': query['sql'], 'time': float(query['time'])}
+                                for query in list(connection.queries_log)[start:])
+
+
+class RequestProfiler(object):
+    """
+    Profiles the rest of a request handled by the current thread
+    """
+    def __init__(self, interval):
+        self.sampler = StackSampler(threading.get_ident(), interval)
+        self.recorder = QueryRecorder()
+        self.started = None
+        self.duration = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.recorder.start()
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+        self.recorder.stop()
+        self.duration = (time.perf_counter() - self.started) * 1000
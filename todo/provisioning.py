@@ -0,0 +1,116 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import Case, Value, When
+from rest_framework.authtoken.models import Token
+
+from .models import UserShard, Profile
+
+# Columns of users a directory entry may set
+USER_FIELDS = ('email', 'first_name', 'last_name')
+# Users updated by one statement, each of them takes 3 parameters and SQLite allows 999
+UPDATE_CHUNK_SIZE = 300
+# Users of one batch, they are looked up by lists of usernames and ids and SQLite allows 999 parameters
+MAX_BATCH_SIZE = 999
+
+
+def place_users(user_pks, new_pks):
+    """
+    Finds shards of many users at once, new users are placed by their id like `UserShard.lookup` does
+    :param new_pks: ids of users created in the current transaction
+    :return: dict of shard alias to list of user ids
+    """
+    if len(settings.SHARDS) == 1:
+        return {settings.SHARDS[0]: list(user_pks)}
+    aliases = dict(UserShard.objects.filter(user_id__in=user_pks).values_list('user_id', 'alias'))
+    placement, user_shards = {}, []
+    for user_pk in user_pks:
+        alias = aliases.get(user_pk)
+        if alias is None and user_pk in new_pks:
+            alias = settings.SHARDS[user_pk % len(settings.SHARDS)]
+            user_shards.append(UserShard(user_id=user_pk, alias=alias))
+        elif alias is None:
+            alias = UserShard.get_alias(user_pk)
+        placement.setdefault(alias, []).append(user_pk)
+    UserShard.objects.bulk_create(user_shards)
+    return placement
+
+
+def _update_users(changes):
+    """
+    Writes changed columns of existing users, one statement per column and `UPDATE_CHUNK_SIZE` users
+    :param changes: dict of user id to dict of changed columns
+    """
+    User = get_user_model()
+    for field in USER_FIELDS:
+        values = [(user_pk, columns[field]) for user_pk, columns in changes.items() if field in columns]
+        for i in range(0, len(values), UPDATE_CHUNK_SIZE):
+            chunk = values[i:i + UPDATE_CHUNK_SIZE]
+            User.objects.filter(pk__in=[user_pk for user_pk, value in chunk]).update(**{field: Case(
+                *[When(pk=user_pk, then=Value(value)) for user_pk, value in chunk],
+                output_field=User._meta.get_field(field))})
+
+
+def _provision_profiles(alias, timezones):
+    """
+    :param timezones: dict of user id to time zone name, None keeps the current one or sets the default
+    """
+    profiles = Profile.objects.using(alias)
+    with transaction.atomic(using=alias):
+        current = {user_pk: str(tz) for user_pk, tz in profiles.filter(user_id__in=timezones).values_list(
+            'user_id', 'timezone')}
+        # One statement for all users moving to a time zone
+        changed = {}
+        for user_pk, tz in timezones.items():
+            if user_pk in current and tz is not None and current[user_pk] != tz:
+                changed.setdefault(tz, []).append(user_pk)
+        for tz, user_pks in changed.items():
+            profiles.filter(user_id__in=user_pks).update(timezone=tz)
+        profiles.bulk_create(Profile(user_id=user_pk, timezone=tz or settings.TIME_ZONE)
+                             for user_pk, tz in timezones.items() if user_pk not in current)
+
+
+def provision_batch(entries):
+    """
+    Creates users of directory entries or updates them in place, with their profiles and API tokens
+
+    Rows are inserted in bulk in one transaction per database, skipping `create_auth_token`
+    and other model signals which would cost queries for every user. Queries don't grow with
+    the number of new users, updates of existing ones take a statement per changed column and `UPDATE_CHUNK_SIZE` users
+    :param entries: dicts with `username`, optionally `USER_FIELDS` and `timezone`
+    :return: (number of created users, number of updated users)
+    :raise ValueError: if there are more than `MAX_BATCH_SIZE` users
+    """
+    User = get_user_model()
+    entries = {entry['username']: entry for entry in entries}
+    if len(entries) > MAX_BATCH_SIZE:
+        raise ValueError('At most {0} users can be provisioned at once'.format(MAX_BATCH_SIZE))
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        existing = {user.username: user for user in User.objects.filter(username__in=entries)}
+        changes = {}
+        for username, user in existing.items():
+            columns = {field: entries[username][field] for field in USER_FIELDS
+                       if field in entries[username] and getattr(user, field) != entries[username][field]}
+            if columns:
+                changes[user.pk] = columns
+        _update_users(changes)
+        User.objects.bulk_create(
+            User(username=username, password=make_password(None),
+                 **{field: entry[field] for field in USER_FIELDS if field in entry})
+            for username, entry in entries.items() if username not in existing)
+
+        # Bulk inserts don't return ids on SQLite
+        user_pks = dict(User.objects.filter(username__in=entries).values_list('username', 'pk'))
+        new_pks = {user_pk for username, user_pk in user_pks.items() if username not in existing}
+
+        with_token = set(Token.objects.filter(user_id__in=user_pks.values()).values_list('user_id', flat=True))
+        tokens = [Token(user_id=user_pk) for user_pk in user_pks.values() if user_pk not in with_token]
+        for token in tokens:
+            token.key = token.generate_key()
+        Token.objects.bulk_create(tokens)
+
+        timezones = {user_pk: entries[username].get('timezone') for username, user_pk in user_pks.items()}
+        for alias, shard_user_pks in place_users(list(timezones), new_pks).items():
+            _provision_profiles(alias, {user_pk: timezones[user_pk] for user_pk in shard_user_pks})
+    return len(new_pks), len(changes)
@@ -0,0 +1,71 @@
+"""
+Rank keys for manually ordered rows
+
+Keys are base 36 fractions between 0 and 1 written without "0." and trailing zeros, so they sort as strings
+and there is always a key between two different keys. Moving a row means giving it one new key
+"""
+DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+BASE = len(DIGITS)
+# Keys added at either end step by one at this digit, so they stay short until BASE ** WIDTH of them
+WIDTH = 4
+
+
+def _encode(value, width):
+    digits = []
+    for _ in range(width):
+        value, digit = divmod(value, BASE)
+        digits.append(DIGITS[digit])
+    return ''.join(reversed(digits)).rstrip('0')
+
+
+def _head(key):
+    return int(key[:WIDTH].ljust(WIDTH, '0'), BASE)
+
+
+def _midpoint(low, high):
+    """
+    :param high: None for the end of the key space
+    """
+    if high is not None:
+        n = 0
+        while n < len(high) and (low[n] if n < len(low) else '0') == high[n]:
+            n += 1
+        if n:
+            return high[:n] + _midpoint(low[n:], high[n:])
+    low_digit = DIGITS.index(low[0]) if low else 0
+    high_digit = DIGITS.index(high[0]) if high is not None else BASE
+    if high_digit - low_digit > 1:
+        return DIGITS[(low_digit + high_digit) // 2]
+    if high is not None and len(high) > 1:
+        return high[0]
+    return DIGITS[low_digit] + _midpoint(low[1:], None)
+
+
+def key_between(low, high):
+    """
+    :param low: key to sort after, None for the start
+    :param high: key to sort before, None for the end
+    :return: shortest key between them
+    """
+    if low is not None and high is not None:
+        if low >= high:
+            raise ValueError('No key between {0!r} and {1!r}'.format(low, high))
+        return _midpoint(low, high)
+    if low is not None:
+        head = _head(low) + 1
+        return _encode(head, WIDTH) if head < BASE ** WIDTH else _midpoint(low, None)
+    if high is not None:
+        head = _head(high) - 1
+        return _encode(head, WIDTH) if head > 0 else _midpoint('', high)
+    return _midpoint('', None)
+
+
+def spread(count):
+    """
+    :return: `count` short keys evenly spaced over the key space, in order
+    """
+    width = 2
+    while BASE ** width < (count + 1) * BASE:
+        width += 1
+    step = BASE ** width // (count + 1)
+    return [_encode(step * (i + 1), width) for i in range(count)]
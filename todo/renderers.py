@@ -0,0 +1,62 @@
+import msgpack
+from rest_framework.renderers import BaseRenderer
+from rest_framework.utils.mediatypes import _MediaType
+
+
+def to_columns(rows):
+    """
+    Turns a list of dicts with the same keys into column names and lists of values
+    """
+    columns = list(rows[0].keys()) if rows else []
+    return {'columns': columns, 'rows': [[row[column] for column in columns] for row in rows]}
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders responses as MessagePack, datetimes are packed as native timestamps
+
+    With `Accept: application/msgpack; layout=columnar` lists of objects are sent
+    as `{"columns": [...], "rows": [[...], ...]}`, so keys are sent once
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    # Asks `DateTimeTzAwareField` to leave datetimes to the renderer
+    native_datetimes = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if accepted_media_type and _MediaType(accepted_media_type).params.get('layout') == b'columnar':
+            if isinstance(data, list):
+                data = to_columns(data)
+            elif isinstance(data, dict) and isinstance(data.get('results'), list):
+                data = dict(data, results=to_columns(data['results']))
+        return msgpack.packb(data, use_bin_type=True, datetime=True)
+
+
+class PrometheusRenderer(BaseRenderer):
+    """
+    Renders the Prometheus text exposition format, the data is the text already
+    """
+    # Parameters would stop DRF from matching `*/*`, `version=0.0.4` is added by the view
+    media_type = 'text/plain'
+    format = 'prometheus'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return str(data).encode(self.charset) if data is not None else b''
+
+
+class EventStreamRenderer(BaseRenderer):
+    """
+    Lets views accept `text/event-stream`, they respond with a streaming response themselves
+    """
+    media_type = 'text/event-stream'
+    format = 'sse'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        # Only errors are rendered, as a comment line
+        return ': {0}\n\n'.format(data).encode(self.charset) if data is not None else b''
@@ -0,0 +1,163 @@
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from .models import UserShard
+
+
+REPLICA_DB_ALIAS = 'replica'
+
+# Models of the `todo` app scoped by user, everything else lives on the primary
+SHARDED_MODELS = ('profile', 'category', 'tag', 'todo', 'todo_tags', 'archivedtodo', 'archivedtodo_tags')
+
+_state = threading.local()
+
+
+class PrimaryPins(object):
+    """
+    Users whose reads stick to the primary until a time, kept in a SQLite file (`REPLICA_PINS_DATABASE`)
+    shared by workers, so a read served by any worker sees the writes made through the others
+    """
+    PRUNE_EVERY = 1000
+
+    def __init__(self):
+        self._local = threading.local()
+        self._pins = 0
+
+    def _connect(self, path):
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS pin ('
+                           'user_id INTEGER PRIMARY KEY, '
+                           'until REAL NOT NULL'
+                           ')')
+        return connection
+
+    @property
+    def connection(self):
+        path = settings.REPLICA_PINS_DATABASE
+        if getattr(self._local, 'path', None) != path:
+            self._local.connection = self._connect(path)
+            self._local.path = path
+        return self._local.connection
+
+    def pin(self, user_pk, seconds):
+        now = time.time()
+        connection = self.connection
+        connection.execute('INSERT OR REPLACE INTO pin (user_id, until) VALUES (?, ?)', (user_pk, now + seconds))
+        self._pins += 1
+        if self._pins % self.PRUNE_EVERY == 0:
+            connection.execute('DELETE FROM pin WHERE until < ?', (now,))
+
+    def is_pinned(self, user_pk):
+        row = self.connection.execute('SELECT until FROM pin WHERE user_id = ?', (user_pk,)).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM pin')
+
+
+pins = PrimaryPins()
+
+
+def replica_available():
+    if REPLICA_DB_ALIAS not in settings.DATABASES:
+        return False
+    # A test mirror shares the database with the primary, reading from it gives nothing
+    return connections[REPLICA_DB_ALIAS].settings_dict['NAME'] != connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+
+
+def pin_to_primary(user):
+    """
+    Makes reads of the user stick to the primary for `REPLICA_PIN_SECONDS`,
+    so users always see their own writes even if the replica is lagging behind
+    """
+    pins.pin(user.pk, settings.REPLICA_PIN_SECONDS)
+
+
+def is_pinned_to_primary(user):
+    return pins.is_pinned(user.pk)
+
+
+def start_replica_reads(user):
+    """
+    Routes reads of the current thread to the replica unless it is not configured,
+    the user has written recently or lives on a shard other than the primary
+    :return: True if reads will go to the replica
+    """
+    _state.use_replica = (replica_available() and not is_pinned_to_primary(user) and
+                          UserShard.get_alias(user.pk) == DEFAULT_DB_ALIAS)
+    return _state.use_replica
+
+
+def stop_replica_reads():
+    _state.use_replica = False
+
+
+def reading_from_replica():
+    return getattr(_state, 'use_replica', False)
+
+
+class ReadReplicaRouter(object):
+    """
+    Sends reads to the replica only inside `start_replica_reads`/`stop_replica_reads`,
+    everything else is left to the next routers
+    """
+    def db_for_read(self, model, **hints):
+        if reading_from_replica():
+            return REPLICA_DB_ALIAS
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replica is a copy of the primary made by `manage.py sync_replica`
+        if db == REPLICA_DB_ALIAS:
+            return False
+        return None
+
+
+def is_sharded(model):
+    return model._meta.app_label == 'todo' and model._meta.model_name in SHARDED_MODELS
+
+
+class ShardRouter(object):
+    """
+    Keeps rows of the `todo` app on the shard of their user (see `UserShard`)
+
+    Queries find the user either from the `instance` hint or from the `user_pk` hint
+    added by `ShardedQuerySet.for_user`, queries without them go to the primary
+    """
+    def _db_for_model(self, model, hints):
+        if not is_sharded(model):
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is None:
+            user_pk = hints.get('user_pk')
+        elif isinstance(instance, get_user_model()):
+            user_pk = instance.pk
+        elif is_sharded(type(instance)) and instance._state.db:
+            return instance._state.db
+        else:
+            user_pk = getattr(instance, 'user_id', None)
+        if user_pk is None:
+            return None
+        return UserShard.get_alias(user_pk)
+
+    def db_for_read(self, model, **hints):
+        return self._db_for_model(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db_for_model(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Sharded rows reference users living on the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in settings.SHARDS:
+            return None
+        return app_label == 'todo' and (model_name is None or model_name in SHARDED_MODELS)
@@ -1,39 +1,131 @@
-from django.utils.timezone import localtime
+from bisect import bisect_right
+
+from django.utils.timezone import localtime, get_current_timezone, utc
 from django.core.exceptions import ValidationError
 from rest_framework import serializers
 
 from .models import Tag, Category, Todo
 
 
+class ZoneTransitions(object):
+    """
+    UTC transition table of a pytz zone, converts many datetimes with one lookup per DST period
+    instead of the `utcoffset` lookup `localtime` does for each of them
+    """
+    _cache = {}
+
+    def __init__(self, tz):
+        self.tz = tz
+        # Only pytz zones with DST have a transition table, others are converted with `localtime`
+        self.times = getattr(tz, '_utc_transition_times', None)
+        if self.times is not None:
+            self.periods = [(info[0], tz._tzinfos[info]) for info in tz._transition_info]
+
+    @classmethod
+    def get(cls, tz):
+        """
+        :return: cached transitions of the zone
+        """
+        transitions = cls._cache.get(tz)
+        if transitions is None:
+            transitions = cls._cache[tz] = cls(tz)
+        return transitions
+
+    def localize_many(self, values):
+        """
+        Converts aware datetimes the same way `localtime` does, `None` stays `None`
+        :return: dict of datetime to local datetime
+        """
+        if self.times is None:
+            return {value: localtime(value, self.tz) for value in values if value is not None}
+        result = {}
+        # Values of a page are usually close to each other, so the last period is tried first
+        start, end, offset, tzinfo = None, None, None, None
+        for value in values:
+            if value is None or value in result:
+                continue
+            naive = (value if value.tzinfo is utc else value.astimezone(utc)).replace(tzinfo=None)
+            if start is None or not start <= naive < end:
+                index = max(0, bisect_right(self.times, naive) - 1)
+                start = self.times[index] if index else naive.min
+                end = self.times[index + 1] if index + 1 < len(self.times) else naive.max
+                offset, tzinfo = self.periods[index]
+            result[value] = (naive + offset).replace(tzinfo=tzinfo)
+        return result
+
+
 class DateTimeTzAwareField(serializers.DateTimeField):
+    """
+    Represents datetimes in the current time zone, list serializers set `localized` for the whole page at once
+    """
+    localized = None
+
     def to_representation(self, value, *args, **kwargs):
         if value:
-            value = localtime(value)
+            localized = self.localized
+            value = localized[value] if localized is not None and value in localized else localtime(value)
+            # Binary formats send datetimes as native timestamps
+            renderer = getattr(self.context.get('request'), 'accepted_renderer', None)
+            if getattr(renderer, 'native_datetimes', False):
+                return value
         return super().to_representation(value, *args, **kwargs)
 
 
 class PrimaryKeyRelatedByUser(serializers.PrimaryKeyRelatedField):
     def get_queryset(self):
-        return super().get_queryset().filter(user=self.context['request'].user)
+        return super().get_queryset().for_user(self.context['request'].user)
+
+
+class SparseFieldsMixin(object):
+    """
+    Leaves only fields listed in the `fields` argument
+    """
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+
+class TzAwareListSerializer(serializers.ListSerializer):
+    """
+    Converts datetimes of `DateTimeTzAwareField` fields of all items in one batch
+    """
+    def to_representation(self, data):
+        items = list(data.all() if hasattr(data, 'all') else data)
+        fields = [field for field in self.child._readable_fields if isinstance(field, DateTimeTzAwareField)]
+        transitions = ZoneTransitions.get(get_current_timezone())
+        for field in fields:
+            field.localized = transitions.localize_many(
+                field.get_attribute(item) for item in items if not isinstance(item, dict))
+        try:
+            return super().to_representation(items)
+        finally:
+            for field in fields:
+                field.localized = None
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Tag
         fields = ('id', 'name', 'color')
 
 
-class CategorySerializer(serializers.ModelSerializer):
+class CategorySerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = ('id', 'name')
 
 
-class TodoSerializer(serializers.ModelSerializer):
+class TodoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     deadline = DateTimeTzAwareField(required=False, allow_null=True)
     category = PrimaryKeyRelatedByUser(required=False, allow_null=True, queryset=Category.objects.all())
     tags = PrimaryKeyRelatedByUser(required=False, many=True, queryset=Tag.objects.all())
 
     class Meta:
         model = Todo
-        fields = ('id', 'category', 'tags', 'text', 'is_done', 'deadline')
\ No newline at end of file
+        fields = ('id', 'category', 'tags', 'text', 'is_done', 'deadline', 'position')
+        # Changed by moving the todo
+        read_only_fields = ('position',)
+        list_serializer_class = TzAwareListSerializer
\ No newline at end of file
@@ -0,0 +1,118 @@
+import time
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from .models import UserShard, Profile, Category, Tag, Todo, ArchivedTodo
+
+
+def shard_user_counts(user_pks):
+    """
+    :return: dict of shard alias to list of ids of users living on it
+    """
+    placement = {alias: [] for alias in settings.SHARDS}
+    for user_pk in user_pks:
+        placement.setdefault(UserShard.get_alias(user_pk), []).append(user_pk)
+    return placement
+
+
+def plan_rebalance(user_pks):
+    """
+    Plans moves that even out the number of users on shards
+    :return: list of (user id, source alias, target alias)
+    """
+    placement = shard_user_counts(user_pks)
+    moves = []
+    while True:
+        source = max(placement, key=lambda alias: len(placement[alias]))
+        target = min(placement, key=lambda alias: len(placement[alias]))
+        if len(placement[source]) - len(placement[target]) <= 1:
+            return moves
+        user_pk = placement[source].pop()
+        placement[target].append(user_pk)
+        moves.append((user_pk, source, target))
+
+
+# Models with tags, their links are copied after the models
+TAGGED_MODELS = (Todo, ArchivedTodo)
+
+
+def _copy_user(user_pk, source, target):
+    with transaction.atomic(using=target):
+        for model in (Profile, Category, Tag) + TAGGED_MODELS:
+            model.objects.using(target).bulk_create(model.objects.using(source).filter(user_id=user_pk))
+        for model in TAGGED_MODELS:
+            through = model.tags.through
+            links = list(through.objects.using(source).filter(**{model._meta.model_name + '__user_id': user_pk}))
+            for link in links:
+                link.pk = None
+            through.objects.using(target).bulk_create(links)
+
+
+def delete_user(user_pk, alias):
+    """
+    Deletes all rows of the user on the shard with set-based statements, the user itself is left alone
+    """
+    with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+        for model in TAGGED_MODELS:
+            cursor.execute('DELETE FROM {0} WHERE {1}_id IN (SELECT id FROM {2} WHERE user_id = %s)'.format(
+                model.tags.through._meta.db_table, model._meta.model_name, model._meta.db_table), [user_pk])
+        for model in TAGGED_MODELS + (Tag, Category, Profile):
+            cursor.execute('DELETE FROM {0} WHERE user_id = %s'.format(model._meta.db_table), [user_pk])
+
+
+def move_users(moves, grace_seconds=None):
+    """
+    Moves all rows of the users to their target shards while the site is running
+
+    Writes of the users are rejected while the rows are copied, reads keep going to the old shards
+    until the directory is switched. All users of the batch go through each step together, steps are
+    separated by `grace_seconds` (`SHARD_CACHE_SECONDS` by default), so every worker sees the new state
+    of the directory before the next step. If a copy fails, users not switched yet stay where they were
+    :param moves: list of (user id, target alias)
+    :return: list of (user id, source alias, target alias) of the moved users
+    """
+    if grace_seconds is None:
+        grace_seconds = settings.SHARD_CACHE_SECONDS
+    moves = [(user_pk, UserShard.get_alias(user_pk), target) for user_pk, target in moves]
+    moves = [(user_pk, source, target) for user_pk, source, target in moves if source != target]
+    if not moves:
+        return []
+
+    for user_pk, source, target in moves:
+        UserShard.objects.update_or_create(user_id=user_pk, defaults={'alias': source, 'moving_to': target})
+        UserShard.forget(user_pk)
+    switched = []
+    try:
+        time.sleep(grace_seconds)
+        for user_pk, source, target in moves:
+            _copy_user(user_pk, source, target)
+            UserShard.objects.filter(user_id=user_pk).update(alias=target, moving_to='')
+            UserShard.forget(user_pk)
+            switched.append((user_pk, source, target))
+    except Exception:
+        for user_pk, source, target in moves[len(switched):]:
+            UserShard.objects.filter(user_id=user_pk).update(moving_to='')
+            UserShard.forget(user_pk)
+            delete_user(user_pk, target)
+        _delete_sources(switched, grace_seconds)
+        raise
+    _delete_sources(switched, grace_seconds)
+    return switched
+
+
+def _delete_sources(moves, grace_seconds):
+    if not moves:
+        return
+    # Reads started before the switch may still go to the old shards
+    time.sleep(grace_seconds)
+    for user_pk, source, target in moves:
+        delete_user(user_pk, source)
+
+
+def move_user(user_pk, target, grace_seconds=None):
+    """
+    Moves all rows of the user to the target shard, see `move_users`
+    :return: True if the user was moved, False if the user already lives there
+    """
+    return bool(move_users([(user_pk, target)], grace_seconds))
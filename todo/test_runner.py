@@ -0,0 +1,22 @@
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+from .metrics import metrics
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Keeps stores shared by workers through SQLite files (throttling, change feed, metrics and replica pins)
+    in memory while tests run, so they never touch the files of a development server
+    """
+    def setup_test_environment(self, **kwargs):
+        super(TestRunner, self).setup_test_environment(**kwargs)
+        self._in_memory_stores = override_settings(THROTTLE_DATABASE=':memory:', CHANGES_DATABASE=':memory:',
+                                                   METRICS_DATABASE=':memory:', REPLICA_PINS_DATABASE=':memory:')
+        self._in_memory_stores.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        # Metrics recorded by tests would be flushed into the file of `METRICS_DATABASE` at exit
+        metrics.clear()
+        self._in_memory_stores.disable()
+        super(TestRunner, self).teardown_test_environment(**kwargs)
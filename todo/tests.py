@@ -1,12 +1,41 @@
-from django.test import TestCase
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from io import StringIO
+from unittest import mock
+
+import msgpack
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, connection, connections, router, transaction
+from django.db.models import Max
 from django.core.urlresolvers import reverse
 from django.utils import timezone
 from django.contrib.auth import get_user_model
 from rest_framework.test import APIRequestFactory, force_authenticate
 from rest_framework import status
+from rest_framework.authtoken.models import Token
 
-from .models import Category, Todo, Profile
-from .views import CategoryDetail, CategoryList, TagDetail, TagList, TodoDetail, TodoList
+from .serializers import TodoSerializer
+from .models import ArchivedTodo, Category, Tag, Todo, Profile, UserShard, ShardSequence, RequestProfile
+from . import backup, profiling, ranking, routers, sharding, throttling, warmup
+from .autocomplete import autocomplete
+from .changes import ChangeLog, change_log
+from .provisioning import provision_batch
+from .metrics import RETIRED, metrics
+from .views import (CategoryDetail, CategoryList, CategoryMerge, TagDetail, TagList, TagMerge, TodoDetail, TodoList,
+                    TodoMove, ArchivedTodoRestore, ChangeFeed, Autocomplete)
 
 
 class DefaultCategoryTestCase(TestCase):
@@ -148,4 +177,1062 @@ class ApiUserRestrictionCategoryDetailTestCase(TestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
         self.other_category = Category.objects.get(id=self.other_category.id)
         self.assertNotEqual(self.other_category.name, data['name'])
-        self.assertEqual(self.other_category.user.id, self.other_user.id)
\ No newline at end of file
+        self.assertEqual(self.other_category.user.id, self.other_user.id)
+
+
+class ReadReplicaRoutingTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        self.router = routers.ReadReplicaRouter()
+        self.factory = APIRequestFactory()
+        self.url = reverse('todo:category-list')
+        routers.pins.clear()
+
+    def tearDown(self):
+        routers.stop_replica_reads()
+
+    @mock.patch.object(routers, 'replica_available', return_value=False)
+    def test_reads_go_to_primary_without_replica(self, _):
+        self.assertFalse(routers.start_replica_reads(self.user))
+        self.assertIsNone(self.router.db_for_read(Todo))
+
+    @mock.patch.object(routers, 'replica_available', return_value=True)
+    def test_reads_stick_to_primary_after_write(self, _):
+        self.assertTrue(routers.start_replica_reads(self.user))
+        self.assertEqual(self.router.db_for_read(Todo), routers.REPLICA_DB_ALIAS)
+        self.assertEqual(router.db_for_write(Todo), DEFAULT_DB_ALIAS)
+        routers.stop_replica_reads()
+        self.assertIsNone(self.router.db_for_read(Todo))
+
+        request = self.factory.post(self.url, {'name': 'New category'}, format='json')
+        force_authenticate(request, self.user, self.user.auth_token)
+        response = CategoryList.as_view()(request)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertTrue(routers.is_pinned_to_primary(self.user))
+        self.assertFalse(routers.start_replica_reads(self.user))
+
+    def test_pins_are_shared_by_processes(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'pins.sqlite3')
+        code = 'import django; django.setup(); from todo import routers; routers.pins.pin({0}, 60)'.format(self.user.pk)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='mytodo.settings', MYTODO_REPLICA_PINS_DB=path)
+        subprocess.check_call([sys.executable, '-c', code], cwd=settings.BASE_DIR, env=env)
+        self.assertFalse(routers.is_pinned_to_primary(self.user))
+        with self.settings(REPLICA_PINS_DATABASE=path):
+            self.assertTrue(routers.is_pinned_to_primary(self.user))
+
+    def test_expired_pins(self):
+        routers.pins.pin(self.user.pk, -1)
+        self.assertFalse(routers.is_pinned_to_primary(self.user))
+
+
+class ReplicaDatabaseTestCase(TransactionTestCase):
+    """
+    Reads from a real replica file, `sync_replica` of the test database is done through its connection
+    because it is kept in memory
+    """
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'replica.sqlite3')
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        routers.pins.clear()
+        connections.databases[routers.REPLICA_DB_ALIAS] = dict(connections.databases[DEFAULT_DB_ALIAS],
+                                                               NAME=self.path)
+
+    def tearDown(self):
+        routers.stop_replica_reads()
+        connections[routers.REPLICA_DB_ALIAS].close()
+        del connections[routers.REPLICA_DB_ALIAS]
+        del connections.databases[routers.REPLICA_DB_ALIAS]
+
+    def sync(self):
+        connection.ensure_connection()
+        target = sqlite3.connect(self.path)
+        try:
+            connection.connection.backup(target)
+        finally:
+            target.close()
+
+    def category_names(self):
+        return list(Category.objects.for_user(self.user).order_by('name').values_list('name', flat=True))
+
+    def test_reads_from_replica(self):
+        Category.objects.create(user=self.user, name='Synced')
+        self.sync()
+        Category.objects.create(user=self.user, name='Not synced')
+        self.assertTrue(routers.replica_available())
+
+        self.assertTrue(routers.start_replica_reads(self.user))
+        self.assertEqual(self.category_names(), ['Synced'])
+        routers.stop_replica_reads()
+        self.assertEqual(self.category_names(), ['Not synced', 'Synced'])
+
+        self.sync()
+        self.assertTrue(routers.start_replica_reads(self.user))
+        self.assertEqual(self.category_names(), ['Not synced', 'Synced'])
+
+    def test_new_user_before_sync(self):
+        self.sync()
+        user = get_user_model().objects.create(username='new_user')
+        Profile(user=user).save()
+        user = get_user_model().objects.get(pk=user.pk)
+        request = APIRequestFactory().get(reverse('todo:category-list'))
+        force_authenticate(request, user, user.auth_token)
+        response = CategoryList.as_view()(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_sync_replica(self):
+        primary_path = os.path.join(self.directory, 'primary.sqlite3')
+        primary = sqlite3.connect(primary_path)
+        primary.execute('CREATE TABLE item (name TEXT)')
+        primary.execute("INSERT INTO item VALUES ('first')")
+        primary.commit()
+        databases = dict(settings.DATABASES)
+        databases[DEFAULT_DB_ALIAS] = dict(databases[DEFAULT_DB_ALIAS], NAME=primary_path)
+        databases[routers.REPLICA_DB_ALIAS] = dict(databases[DEFAULT_DB_ALIAS], NAME=self.path)
+
+        replica = sqlite3.connect(self.path)
+        self.addCleanup(replica.close)
+        self.addCleanup(primary.close)
+        # Only settings are read by the command, connections of the test database are left alone
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            with self.settings(DATABASES=databases):
+                call_command('sync_replica', stdout=StringIO())
+                self.assertEqual(replica.execute('SELECT name FROM item').fetchall(), [('first',)])
+                # Open connections of the replica see the next sync
+                primary.execute("INSERT INTO item VALUES ('second')")
+                primary.commit()
+                call_command('sync_replica', stdout=StringIO())
+        self.assertEqual(replica.execute('SELECT name FROM item ORDER BY name').fetchall(),
+                         [('first',), ('second',)])
+
+
+@override_settings(SHARDS=['default', 'shard1'])
+class ShardRoutingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.router = routers.ShardRouter()
+
+    def test_existing_users_stay_on_primary(self):
+        with self.settings(SHARDS=['default']):
+            user = get_user_model().objects.create(username='old_user')
+            Profile(user=user).save()
+        self.assertEqual(UserShard.get_alias(user.pk), DEFAULT_DB_ALIAS)
+        self.assertEqual(UserShard.objects.get(user=user).alias, DEFAULT_DB_ALIAS)
+
+    def test_new_users_are_placed_by_id(self):
+        user = get_user_model().objects.create(username='new_user')
+        alias = settings.SHARDS[user.pk % 2]
+        self.assertEqual(UserShard.get_alias(user.pk), alias)
+        self.assertFalse(UserShard.is_moving(user.pk))
+        self.assertEqual(self.router.db_for_read(Todo, user_pk=user.pk), alias)
+        self.assertEqual(self.router.db_for_write(Profile, instance=user), alias)
+        self.assertEqual(self.router.db_for_write(Todo, instance=Todo(user=user)), alias)
+        self.assertEqual(self.router.db_for_read(get_user_model(), instance=Todo(user=user)), DEFAULT_DB_ALIAS)
+        self.assertEqual(Todo.objects.for_user(user).db, alias)
+
+        UserShard.objects.filter(user=user).update(alias='shard1', moving_to=DEFAULT_DB_ALIAS)
+        UserShard.forget(user.pk)
+        self.assertEqual(UserShard.lookup(user.pk), ('shard1', True))
+
+    def test_sharded_ids_are_unique(self):
+        ShardSequence._blocks.clear()
+        ShardSequence.objects.create(name='todo.tag', value=1000)
+        ids = [ShardSequence.allocate_id(Tag) for _ in range(ShardSequence.BLOCK_SIZE + 2)]
+        self.assertEqual(ids, list(range(1000, 1000 + ShardSequence.BLOCK_SIZE + 2)))
+        self.assertEqual(ShardSequence.objects.get(name='todo.tag').value, 1000 + 2 * ShardSequence.BLOCK_SIZE)
+
+    def test_rolled_back_blocks_are_dropped(self):
+        ShardSequence._blocks.clear()
+        ShardSequence.objects.create(name='todo.tag', value=1000)
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.assertEqual(ShardSequence.allocate_id(Tag), 1000)
+            raise RuntimeError()
+        self.assertEqual(ShardSequence.objects.get(name='todo.tag').value, 1000)
+        # Other process reserves the block again
+        ShardSequence.objects.filter(name='todo.tag').update(value=1000 + ShardSequence.BLOCK_SIZE)
+        self.assertEqual(ShardSequence.allocate_id(Tag), 1000 + ShardSequence.BLOCK_SIZE)
+
+    def test_todo_ids_start_after_archived(self):
+        ShardSequence._blocks.clear()
+        with self.settings(SHARDS=['default']):
+            user = get_user_model().objects.create(username='archived_user')
+            category = Category.objects.create(user=user, name='Archived')
+            ArchivedTodo.objects.create(id=5000, user=user, category=category, text='Archived')
+            self.assertEqual(ShardSequence.allocate_id(Todo), 5001)
+
+    def test_rebalance_plan(self):
+        placement = {1: 'default', 2: 'default', 3: 'default', 4: 'shard1'}
+        with mock.patch.object(UserShard, 'get_alias', side_effect=placement.get):
+            moves = sharding.plan_rebalance(sorted(placement))
+        self.assertEqual(moves, [(3, 'default', 'shard1')])
+
+
+@override_settings(SHARDS=['default', 'shard1', 'shard2'])
+class ShardMoveTestCase(TestCase):
+    """
+    Moves a user between shards kept in SQLite files
+    """
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for alias in ('shard1', 'shard2'):
+            connections.databases[alias] = dict(connections.databases[DEFAULT_DB_ALIAS],
+                                                NAME=os.path.join(directory, alias + '.sqlite3'))
+            self.addCleanup(self._remove_shard, alias)
+            call_command('migrate', database=alias, verbosity=0, interactive=False)
+        cache.clear()
+        ShardSequence._blocks.clear()
+        self.user = get_user_model().objects.create(username='user')
+        UserShard.objects.update_or_create(user=self.user, defaults={'alias': 'shard1'})
+        Profile(user=self.user).save()
+        self.tag = Tag.objects.create(user=self.user, name='Tag', color='ffffff')
+        self.todo = Todo.objects.create(user=self.user, text='Todo')
+        self.todo.tags.add(self.tag)
+
+    @staticmethod
+    def _remove_shard(alias):
+        connections[alias].close()
+        del connections[alias]
+        del connections.databases[alias]
+
+    def _rows(self, alias):
+        return {model._meta.model_name: list(model.objects.using(alias).filter(user=self.user).order_by('pk')
+                                             .values_list('pk', flat=True)) for model in (Profile, Category, Tag, Todo)}
+
+    def test_move(self):
+        rows = self._rows('shard1')
+        self.assertEqual(rows['todo'], [self.todo.pk])
+        out = StringIO()
+        call_command('rebalance_shards', users=[self.user.pk], target='shard2', grace=0, stdout=out)
+        self.assertIn('User {0} moved from shard1 to shard2'.format(self.user.pk), out.getvalue())
+        self.assertEqual(self._rows('shard2'), rows)
+        self.assertEqual(self._rows('shard1'), {'profile': [], 'category': [], 'tag': [], 'todo': []})
+        self.assertFalse(Todo.tags.through.objects.using('shard1').exists())
+        todo = Todo.objects.using('shard2').get(pk=self.todo.pk)
+        self.assertEqual(list(todo.tags.values_list('pk', flat=True)), [self.tag.pk])
+        self.assertEqual(UserShard.lookup(self.user.pk), ('shard2', False))
+
+        # Ids keep coming from the sequences, after the ids of the moved rows
+        new_todo = Todo.objects.create(user=self.user, text='New')
+        self.assertEqual(new_todo._state.db, 'shard2')
+        self.assertGreater(new_todo.pk, self.todo.pk)
+
+    def test_failed_copy(self):
+        # Left on the target by an earlier move
+        Category.objects.using('shard2').create(pk=self.todo.category_id, user=self.user, name='Stale')
+        with self.assertRaises(IntegrityError):
+            sharding.move_users([(self.user.pk, 'shard2')], grace_seconds=0)
+        self.assertEqual(UserShard.lookup(self.user.pk), ('shard1', False))
+        self.assertEqual(UserShard.objects.get(user=self.user).moving_to, '')
+        self.assertEqual(self._rows('shard2'), {'profile': [], 'category': [], 'tag': [], 'todo': []})
+        self.assertEqual(self._rows('shard1')['todo'], [self.todo.pk])
+
+
+class SlidingWindowThrottleTestCase(TestCase):
+    def setUp(self):
+        self.store = throttling.SlidingWindowStore()
+        self.store.clear()
+
+    def test_sliding_window(self):
+        for now in (0, 10, 20):
+            self.assertIsNone(self.store.hit('key', 3, 60, now))
+        self.assertEqual(self.store.hit('key', 3, 60, 30), 30)
+        self.assertIsNone(self.store.hit('other_key', 3, 60, 30))
+        # Half of the previous window is still in the sliding one: 3 * 0.5 + 1 requests
+        self.assertIsNone(self.store.hit('key', 3, 60, 90))
+        self.assertAlmostEqual(self.store.hit('key', 3, 60, 90), 10)
+        self.assertIsNone(self.store.hit('key', 3, 60, 100))
+        # Windows older than the previous one are forgotten
+        for now in (300, 301, 302):
+            self.assertIsNone(self.store.hit('key', 3, 60, now))
+
+    def test_prune(self):
+        self.store.hit('gone', 3, 60, 0)
+        self.store.PRUNE_EVERY = 1
+        self.store.hit('key', 3, 60, 100)
+        self.assertEqual(self.store.connection.execute('SELECT COUNT(*) FROM throttle').fetchone()[0], 2)
+        # Window of `gone` ended before the previous window of this hit
+        self.store.hit('key', 3, 60, 130)
+        self.assertEqual([row[0] for row in self.store.connection.execute('SELECT key FROM throttle')], ['key'])
+
+
+class AdminTestCase(TestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        Profile(user=self.admin).save()
+        self.client.force_login(self.admin)
+        for i in range(3):
+            Todo.objects.create(user=self.admin, text='Todo {0}'.format(i), is_done=bool(i % 2))
+        cache.clear()
+
+    def test_todo_changelist(self):
+        url = reverse('admin:todo_todo_changelist')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, Todo.objects.aggregate(Max('pk'))['pk__max'])
+        response = self.client.get(url, {'is_done__exact': 1})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertEqual(cache.get('todo:admin-filter:todo.todo:user'), [(self.admin.pk, 'admin')])
+
+    def test_todo_change_tag_choices(self):
+        todo = Todo.objects.first()
+        tag = Tag.objects.create(user=self.admin, name='Tag', color='ffffff')
+        todo.tags.add(tag)
+        response = self.client.get(reverse('admin:todo_todo_change', args=(todo.pk,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '<option value="{0}" selected="selected">Tag</option>'.format(tag.pk))
+
+    def test_todo_changelist_queries(self):
+        url = reverse('admin:todo_todo_changelist')
+        # Fills the cache of the user filter
+        self.client.get(url)
+        with self.assertNumQueries(7):
+            self.client.get(url)
+        for i in range(5):
+            category = Category.objects.create(user=self.admin, name='Category {0}'.format(i))
+            Todo.objects.create(user=self.admin, category=category, text='Todo in {0}'.format(category))
+        with self.assertNumQueries(7):
+            self.client.get(url)
+
+    def test_todo_change_queries(self):
+        todo = Todo.objects.first()
+        url = reverse('admin:todo_todo_change', args=(todo.pk,))
+        todo.tags.add(Tag.objects.create(user=self.admin, name='Tag', color='ffffff'))
+        # Fills the content type cache
+        self.client.get(url)
+        with self.assertNumQueries(16):
+            self.client.get(url)
+        todo.tags.add(*[Tag.objects.create(user=self.admin, name='Tag {0}'.format(i), color='ffffff')
+                        for i in range(5)])
+        with self.assertNumQueries(16):
+            self.client.get(url)
+
+    def test_provision_action(self):
+        user = get_user_model().objects.create(username='user')
+        Token.objects.filter(user=user).delete()
+        response = self.client.post(reverse('admin:auth_user_changelist'),
+                                    {'action': 'provision', '_selected_action': [user.pk]})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(Profile.objects.filter(user=user).exists())
+        self.assertTrue(Token.objects.filter(user=user).exists())
+
+
+class ArchiveTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        self.tag = Tag.objects.create(user=self.user, name='Tag', color='ffffff')
+        self.old = timezone.now() - timezone.timedelta(days=30)
+        self.done = Todo.objects.create(user=self.user, text='Done', is_done=True, deadline=self.old)
+        self.done.tags.add(self.tag)
+        self.active = Todo.objects.create(user=self.user, text='Active', deadline=self.old)
+        self.factory = APIRequestFactory()
+
+    def _list(self, **params):
+        request = self.factory.get('/api/todo/', params)
+        force_authenticate(request, self.user, self.user.auth_token)
+        return TodoList.as_view()(request).data
+
+    def test_archive_and_restore(self):
+        call_command('archive_todos', '--older-than', '7', stdout=StringIO())
+        self.assertEqual(list(Todo.objects.values_list('pk', flat=True)), [self.active.pk])
+        archived = ArchivedTodo.objects.get()
+        self.assertEqual(archived.pk, self.done.pk)
+        self.assertEqual(list(archived.tags.all()), [self.tag])
+        self.assertEqual(archived.category, Category.get_default_category(self.user))
+
+        self.assertEqual(self._list()['count'], 1)
+        data = self._list(include_archived=1)
+        self.assertEqual(data['count'], 2)
+        self.assertEqual([todo['id'] for todo in data['results']], [self.active.pk, self.done.pk])
+        self.assertEqual(data['results'][1]['tags'], [self.tag.pk])
+        self.assertEqual(self._list(include_archived=1, only_done=0)['count'], 1)
+        self.assertEqual(self._list(include_archived=1, limit=1, offset=1)['results'][0]['id'], self.done.pk)
+
+        request = self.factory.post('/api/todo/{0}/restore/'.format(self.done.pk))
+        force_authenticate(request, self.user, self.user.auth_token)
+        response = ArchivedTodoRestore.as_view()(request, pk=self.done.pk)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['tags'], [self.tag.pk])
+        self.assertFalse(ArchivedTodo.objects.exists())
+        self.assertEqual(Todo.objects.get(pk=self.done.pk).text, 'Done')
+
+
+class MessagePackTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user, timezone='Europe/Moscow').save()
+        self.factory = APIRequestFactory()
+
+    def test_create_and_list(self):
+        deadline = timezone.now().replace(microsecond=0)
+        body = msgpack.packb({'text': 'Packed todo', 'deadline': deadline}, datetime=True)
+        request = self.factory.post('/api/todo/', body, content_type='application/msgpack',
+                                    HTTP_ACCEPT='application/msgpack')
+        force_authenticate(request, self.user, self.user.auth_token)
+        response = TodoList.as_view()(request).render()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        created = msgpack.unpackb(response.content, timestamp=3)
+        self.assertEqual(created['deadline'], deadline)
+        self.assertEqual(Todo.objects.get(pk=created['id']).deadline, deadline)
+
+        request = self.factory.get('/api/todo/', HTTP_ACCEPT='application/msgpack; layout=columnar')
+        force_authenticate(request, self.user, self.user.auth_token)
+        data = msgpack.unpackb(TodoList.as_view()(request).render().content, timestamp=3)
+        self.assertEqual(data['count'], 1)
+        self.assertEqual(data['results']['columns'],
+                         ['id', 'category', 'tags', 'text', 'is_done', 'deadline', 'position'])
+        self.assertEqual(data['results']['rows'], [[created['id'], created['category'], [], 'Packed todo', False,
+                                                    deadline, created['position']]])
+
+
+class SparseFieldsTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        self.tag = Tag.objects.create(user=self.user, name='Tag', color='ffffff')
+        self.todo = Todo.objects.create(user=self.user, text='Todo')
+        self.todo.tags.add(self.tag)
+        self.factory = APIRequestFactory()
+
+    def _get(self, view, fields, **kwargs):
+        request = self.factory.get('/api/', {'fields': fields})
+        force_authenticate(request, self.user, self.user.auth_token)
+        with CaptureQueriesContext(connection) as queries:
+            response = view.as_view()(request, **kwargs)
+        return response, [query['sql'] for query in queries.captured_queries]
+
+    def test_todo_list_fields(self):
+        response, queries = self._get(TodoList, 'id,is_done')
+        self.assertEqual(response.data['results'], [{'id': self.todo.pk, 'is_done': False}])
+        self.assertFalse([sql for sql in queries if 'todo_todo_tags' in sql or '"todo_todo"."text"' in sql])
+
+        response, queries = self._get(TodoList, 'id,tags')
+        self.assertEqual(response.data['results'], [{'id': self.todo.pk, 'tags': [self.tag.pk]}])
+        self.assertTrue([sql for sql in queries if 'todo_todo_tags' in sql])
+
+    def test_detail_fields(self):
+        response, _ = self._get(TagDetail, 'name', pk=self.tag.pk)
+        self.assertEqual(response.data, {'name': 'Tag'})
+        response, _ = self._get(TagList, 'name,user')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ChangeFeedTestCase(TransactionTestCase):
+    def setUp(self):
+        # Events are appended from other threads too
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        changes_database = self.settings(CHANGES_DATABASE=os.path.join(directory, 'changes.sqlite3'))
+        changes_database.enable()
+        self.addCleanup(changes_database.disable)
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        self.factory = APIRequestFactory()
+
+    def _get(self, params=None, **extra):
+        request = self.factory.get('/api/changes/', params, **extra)
+        force_authenticate(request, self.user, self.user.auth_token)
+        return ChangeFeed.as_view()(request)
+
+    def test_long_poll(self):
+        since = self._get().data['last_id']
+        todo = Todo.objects.create(user=self.user, text='Todo')
+        data = self._get({'since': since, 'timeout': 0}).data
+        self.assertIn({'model': 'todo', 'object_id': todo.pk, 'action': 'create'},
+                      [{key: event[key] for key in ('model', 'object_id', 'action')} for event in data['events']])
+        self.assertFalse(data['reset'])
+
+        since = data['last_id']
+        timer = threading.Timer(0.1, todo.mark_done, (True,))
+        timer.start()
+        start = time.time()
+        data = self._get({'since': since, 'timeout': 5}).data
+        timer.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([(event['object_id'], event['action']) for event in data['events']], [(todo.pk, 'update')])
+
+    def test_wait_for_other_process(self):
+        since = change_log.last_id()
+        # Appends like another worker, waiters of this one are woken by the watcher
+        other = ChangeLog()
+        timer = threading.Timer(0.1, other.append, (self.user.pk, 'todo', 1, 'update'))
+        timer.start()
+        start = time.time()
+        events = change_log.wait(self.user.pk, since, 5)
+        timer.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual([(event['object_id'], event['action']) for event in events], [(1, 'update')])
+
+    def test_store_errors(self):
+        change_log._start_watcher()
+        missing = os.path.join(settings.CHANGES_DATABASE + '.missing', 'changes.sqlite3')
+        with self.assertLogs('todo.changes', 'ERROR') as logs, self.settings(CHANGES_DATABASE=missing):
+            # Committed changes are kept when their events can't be stored
+            todo = Todo.objects.create(user=self.user, text='Todo')
+            time.sleep(settings.CHANGES_WATCH_INTERVAL * 2)
+        self.assertTrue(Todo.objects.filter(pk=todo.pk).exists())
+        self.assertIn('Lost 1 change events', '\n'.join(logs.output))
+        self.assertTrue(change_log._watcher.is_alive())
+
+        # The watcher still wakes clients once the store is back
+        since = change_log.last_id()
+        timer = threading.Timer(0.1, ChangeLog().append, (self.user.pk, 'todo', 1, 'update'))
+        timer.start()
+        start = time.time()
+        events = change_log.wait(self.user.pk, since, 5)
+        timer.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(len(events), 1)
+
+    @override_settings(CHANGES_MAX_LISTENERS=0)
+    def test_too_many_listeners(self):
+        since = self._get().data['last_id']
+        self.assertEqual(self._get({'since': since, 'timeout': 0}).status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        response = self._get(HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID=str(since))
+        self.assertIn('event: busy\n', b''.join(response.streaming_content).decode())
+
+    @override_settings(CHANGES_STREAM_SECONDS=0.3, CHANGES_HEARTBEAT_SECONDS=0.1)
+    def test_event_stream(self):
+        since = self._get().data['last_id']
+        tag = Tag.objects.create(user=self.user, name='Tag', color='ffffff')
+        response = self._get(HTTP_ACCEPT='text/event-stream', HTTP_LAST_EVENT_ID=str(since))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('event: change\n', content)
+        self.assertIn('"object_id": {0}'.format(tag.pk), content)
+        self.assertIn(': ping\n\n', content)
+
+
+class MergeTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        self.factory = APIRequestFactory()
+
+    def _merge(self, view, source, target):
+        request = self.factory.post('/api/', {'target': target.pk}, format='json')
+        force_authenticate(request, self.user, self.user.auth_token)
+        return view.as_view()(request, pk=source.pk)
+
+    def test_tag_merge(self):
+        work = Tag.objects.create(user=self.user, name='work', color='ffffff')
+        job = Tag.objects.create(user=self.user, name='job', color='ffffff')
+        both = Todo.objects.create(user=self.user, text='Both')
+        both.tags.add(work, job)
+        only_job = Todo.objects.create(user=self.user, text='Only job')
+        only_job.tags.add(job)
+
+        response = self._merge(TagMerge, job, work)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['id'], work.pk)
+        self.assertFalse(Tag.objects.filter(pk=job.pk).exists())
+        self.assertEqual(list(both.tags.all()), [work])
+        self.assertEqual(list(only_job.tags.all()), [work])
+        self.assertEqual(self._merge(TagMerge, work, work).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_category_merge(self):
+        default_todo = Todo.objects.create(user=self.user, text='Default')
+        category = Category.objects.create(user=self.user, name='Category')
+        response = self._merge(CategoryMerge, Category.get_default_category(self.user), category)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(Todo.objects.get(pk=default_todo.pk).category, category)
+        self.assertIsNone(Category.get_default_category(self.user))
+
+        other = Category.objects.create(user=self.user, name='Other')
+        self._merge(CategoryMerge, category, other)
+        self.assertEqual(list(Category.objects.filter(user=self.user)), [other])
+        self.assertEqual(Todo.objects.get(pk=default_todo.pk).category, other)
+
+
+class WarmUpTestCase(SimpleTestCase):
+    def test_warm_up_without_queries(self):
+        # SimpleTestCase fails on any database query, workers must not inherit connections
+        callbacks = warmup.warm_up_urls()
+        self.assertIn(TodoList, [getattr(callback, 'cls', None) for callback in callbacks])
+        warmup.warm_up_views(callbacks)
+        warmup.warm_up_timezones()
+
+
+class TimezoneBatchTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user, timezone='America/New_York').save()
+        self.factory = APIRequestFactory()
+
+    def test_list_across_dst(self):
+        # Clocks in New York went forward at 2016-03-13 07:00 UTC
+        start = timezone.make_aware(timezone.datetime(2016, 3, 13, 6))
+        for i in range(6):
+            Todo.objects.create(user=self.user, text=str(i), deadline=start + timezone.timedelta(minutes=25 * i))
+        Todo.objects.create(user=self.user, text='No deadline')
+
+        request = self.factory.get('/api/todo/')
+        force_authenticate(request, self.user, self.user.auth_token)
+        results = TodoList.as_view()(request).data['results']
+        self.assertEqual(len(results), 7)
+        with timezone.override(self.user.profile.timezone):
+            for result in results:
+                # Serializing a single todo converts its deadline with localtime()
+                self.assertEqual(result['deadline'], TodoSerializer(Todo.objects.get(pk=result['id'])).data['deadline'])
+
+
+class ProfilingTestCase(TestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        Profile(user=self.admin).save()
+        Todo.objects.create(user=self.admin, text='Todo')
+        self.factory = APIRequestFactory()
+
+    def _get(self, user, **extra):
+        request = self.factory.get('/api/todo/', {'tags': 1}, **extra)
+        force_authenticate(request, user, user.auth_token)
+        return TodoList.as_view()(request)
+
+    def test_profile_request(self):
+        response = self._get(self.admin, HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile = RequestProfile.objects.get(pk=response['X-Profile-Id'])
+        self.assertEqual((profile.user, profile.path, profile.status_code), (self.admin, '/api/todo/?tags=1', 200))
+        self.assertGreater(profile.query_count, 0)
+        self.assertIn('todo_todo', profile.queries)
+
+        self.client.force_login(self.admin)
+        download_url = reverse('admin:todo_requestprofile_download', args=(profile.pk, 'sql'))
+        self.assertContains(self.client.get(reverse('admin:todo_requestprofile_changelist')), download_url)
+        self.assertEqual(self.client.get(reverse('admin:todo_requestprofile_change', args=(profile.pk,))).status_code,
+                         200)
+        response = self.client.get(download_url)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="profile-{0}.sql.json"'.format(
+            profile.pk))
+        self.assertEqual(response.content.decode('utf-8'), profile.queries)
+
+    def test_only_staff(self):
+        user = get_user_model().objects.create(username='user')
+        Profile(user=user).save()
+        self.assertNotIn('X-Profile-Id', self._get(user, HTTP_X_PROFILE='1'))
+        self.assertNotIn('X-Profile-Id', self._get(self.admin))
+        self.assertFalse(RequestProfile.objects.exists())
+
+    def test_stack_sampler(self):
+        def busy():
+            deadline = time.perf_counter() + 0.1
+            while time.perf_counter() < deadline:
+                pass
+
+        sampler = profiling.StackSampler(threading.get_ident(), 0.001)
+        sampler.start()
+        busy()
+        sampler.stop()
+        lines = sampler.collapsed().splitlines()
+        self.assertTrue(any(';busy (todo/tests.py:' in line for line in lines))
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.admin = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        Profile(user=self.admin).save()
+        metrics.clear()
+
+    def test_exposition(self):
+        response = self.client.get('/api/todo/', HTTP_AUTHORIZATION='Token {0}'.format(self.admin.auth_token.key))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get('/metrics').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.force_login(self.admin)
+        response = self.client.get('/metrics')
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode('utf-8').splitlines()
+        self.assertIn('# TYPE mytodo_request_duration_seconds histogram', lines)
+        self.assertIn('mytodo_request_duration_seconds_bucket{view="TodoList",method="GET",le="+Inf"} 1.0', lines)
+        self.assertIn('mytodo_request_duration_seconds_count{view="TodoList",method="GET"} 1.0', lines)
+        self.assertIn('mytodo_responses_total{view="TodoList",status="200"} 1.0', lines)
+        queries = [line for line in lines if line.startswith('mytodo_request_queries_sum{view="TodoList"}')]
+        self.assertEqual(len(queries), 1)
+        self.assertGreater(float(queries[0].split()[1]), 0)
+
+    def test_token(self):
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+            self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code,
+                             status.HTTP_401_UNAUTHORIZED)
+
+    def test_merge_processes(self):
+        labels = (('scope', 'user'),)
+        metrics.inc('mytodo_throttled_requests_total', labels)
+        metrics.flush(force=True)
+        # What a forked worker does
+        metrics._reset()
+        metrics.inc('mytodo_throttled_requests_total', labels, 2)
+        metrics.observe('mytodo_request_queries', 4, (('view', 'TagList'),))
+        values = metrics.collect()
+        self.assertEqual(values[('mytodo_throttled_requests_total', labels)], 3)
+        self.assertEqual(values[('mytodo_request_queries_bucket', (('view', 'TagList'), ('le', '5')))], 1)
+
+    def test_retire_processes(self):
+        labels = (('scope', 'user'),)
+        metrics.inc('mytodo_throttled_requests_total', labels)
+        metrics.flush(force=True)
+        # Rows of a worker that has exited
+        child = subprocess.Popen([sys.executable, '-c', ''])
+        child.wait()
+        metrics.connection.execute('UPDATE process SET pid = ?', (child.pid,))
+        metrics._reset()
+        metrics.inc('mytodo_throttled_requests_total', labels, 2)
+        for _ in range(2):
+            self.assertEqual(metrics.collect()[('mytodo_throttled_requests_total', labels)], 3)
+        processes = metrics.connection.execute('SELECT DISTINCT process FROM metric').fetchall()
+        self.assertEqual(sorted(processes), sorted([(RETIRED,), (metrics._process,)]))
+
+
+class AutocompleteTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        self.factory = APIRequestFactory()
+        autocomplete.clear()
+
+        category = Category.objects.create(user=self.user, name='Work projects')
+        work = Tag.objects.create(user=self.user, name='work', color='ffffff')
+        workout = Tag.objects.create(user=self.user, name='Workout', color='ffffff')
+        Tag.objects.create(user=self.user, name='home', color='ffffff')
+        for i in range(3):
+            todo = Todo.objects.create(user=self.user, category=category, text='Todo {0}'.format(i))
+            todo.tags.add(*([work, workout] if i == 0 else [work]))
+
+    def _get(self, params):
+        request = self.factory.get('/api/autocomplete/', params)
+        force_authenticate(request, self.user, self.user.auth_token)
+        response = Autocomplete.as_view()(request)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [(entry['kind'], entry['name'], entry['usage']) for entry in response.data]
+
+    @override_settings(AUTOCOMPLETE_BUILD_AFTER=2)
+    def test_prefix_search(self):
+        expected = [('tag', 'work', 3), ('category', 'Work projects', 3), ('tag', 'Workout', 1)]
+        Tag.objects.create(user=self.user, name='HomeOffice', color='ffffff')
+        # Answered by the database until the index is built, then from the index without queries
+        self.assertEqual(self._get({'q': 'wo'}), expected)
+        self.assertIsNone(autocomplete._get(self.user.pk, change_log.last_id_of_user(self.user.pk)))
+        # Capitals other than the first one are matched by the index only
+        self.assertEqual(self._get({'q': 'homeo'}), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(self._get({'q': 'homeo'}), [('tag', 'HomeOffice', 0)])
+            self.assertEqual(self._get({'q': 'WO'}), expected)
+            self.assertEqual(self._get({'q': 'work', 'kind': 'tag', 'limit': 1}), [('tag', 'work', 3)])
+            self.assertEqual(self._get({'q': 'h'}), [('tag', 'home', 0), ('tag', 'HomeOffice', 0)])
+
+        Tag.objects.create(user=self.user, name='Wok', color='ffffff')
+        self.assertEqual(self._get({'q': 'wo'})[-1], ('tag', 'Wok', 0))
+
+    def test_invalid_params(self):
+        for params in ({'q': 'w', 'kind': 'todo'}, {'q': 'w', 'limit': 100}):
+            request = self.factory.get('/api/autocomplete/', params)
+            force_authenticate(request, self.user, self.user.auth_token)
+            self.assertEqual(Autocomplete.as_view()(request).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class BackupTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _count(self, path):
+        source = sqlite3.connect(path)
+        try:
+            return source.execute('SELECT COUNT(*) FROM item').fetchone()[0]
+        finally:
+            source.close()
+
+    def test_snapshot_and_restore(self):
+        path = os.path.join(self.directory, 'db.sqlite3')
+        source = sqlite3.connect(path)
+        source.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, text TEXT)')
+        source.executemany('INSERT INTO item (text) VALUES (?)', [('x' * 500,)] * 1000)
+        source.commit()
+
+        store = backup.SnapshotStore(os.path.join(self.directory, 'store.sqlite3'))
+        try:
+            first = store.take('default', path, pages=16, sleep=0)
+            self.assertEqual(first['new_pages'], first['page_count'])
+            source.execute('DELETE FROM item WHERE id > 10')
+            source.commit()
+            # Only pages that changed are stored again
+            second = store.take('default', path, pages=16, sleep=0)
+            self.assertLess(second['new_pages'], first['page_count'] // 2)
+
+            store.restore(first['id'], path, pages=16, sleep=0)
+            self.assertEqual(self._count(path), 1000)
+            self.assertEqual(store.prune(keep=1), 1)
+            store.restore(second['id'], path, pages=-1, sleep=0)
+            self.assertEqual(self._count(path), 10)
+        finally:
+            source.close()
+            store.close()
+
+    def test_snapshot_restarted_by_writes(self):
+        path = os.path.join(self.directory, 'db.sqlite3')
+        source = sqlite3.connect(path)
+        source.execute('CREATE TABLE item (id INTEGER PRIMARY KEY, text TEXT)')
+        source.executemany('INSERT INTO item (text) VALUES (?)', [('x' * 500,)] * 1000)
+        source.commit()
+
+        def write(status, remaining, total):
+            source.execute('INSERT INTO item (text) VALUES (?)', ('x',))
+            source.commit()
+
+        store = backup.SnapshotStore(os.path.join(self.directory, 'store.sqlite3'))
+        try:
+            with self.assertRaises(backup.TooManyRestarts):
+                store.take('default', path, pages=16, sleep=0, progress=write, max_restarts=3)
+            self.assertEqual(store.prune(keep=0), 0)
+        finally:
+            source.close()
+            store.close()
+
+    def test_export_and_import_user(self):
+        other = get_user_model().objects.create(username='other')
+        Profile(user=other).save()
+        category = Category.objects.create(user=self.user, name='Work')
+        tag = Tag.objects.create(user=self.user, name='work', color='ffffff')
+        todo = Todo.objects.create(user=self.user, category=category, text='Todo')
+        todo.tags.add(tag)
+        other_todos = Todo.objects.filter(user=other).count()
+
+        stream = StringIO()
+        backup.export_user(self.user.pk, stream)
+        Todo.objects.filter(user=self.user).delete()
+        Tag.objects.create(user=self.user, name='new', color='ffffff')
+        stream.seek(0)
+        self.assertEqual(backup.import_user(stream)[0], self.user.pk)
+
+        self.assertEqual(list(Tag.objects.filter(user=self.user).values_list('name', flat=True)), ['work'])
+        self.assertEqual(list(Todo.objects.get(pk=todo.pk).tags.all()), [tag])
+        self.assertEqual(Todo.objects.filter(user=other).count(), other_todos)
+
+        stream.seek(0)
+        self.user.delete()
+        with self.assertRaises(ValueError):
+            backup.import_user(stream)
+
+
+class PositionTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user).save()
+        self.factory = APIRequestFactory()
+        self.category = Category.objects.create(user=self.user, name='Work')
+        self.todos = [Todo.objects.create(user=self.user, category=self.category, text='Todo {0}'.format(i))
+                      for i in range(4)]
+
+    def _list(self):
+        request = self.factory.get('/api/todo/', {'ordering': 'position', 'category': self.category.pk})
+        force_authenticate(request, self.user, self.user.auth_token)
+        return [todo['text'] for todo in TodoList.as_view()(request).data['results']]
+
+    def _move(self, todo, data):
+        request = self.factory.post('/api/', data, format='json')
+        force_authenticate(request, self.user, self.user.auth_token)
+        return TodoMove.as_view()(request, pk=todo.pk)
+
+    def test_keys(self):
+        keys = [ranking.key_between(None, None)]
+        for i in range(200):
+            index = i * 7 % (len(keys) + 1)
+            low = keys[index - 1] if index else None
+            high = keys[index] if index < len(keys) else None
+            keys.insert(index, ranking.key_between(low, high))
+        self.assertEqual(keys, sorted(set(keys)))
+        self.assertEqual(ranking.spread(3), sorted(ranking.spread(3)))
+        with self.assertRaises(ValueError):
+            ranking.key_between('b', 'a')
+
+    def test_move(self):
+        self.assertEqual(self._list(), ['Todo 0', 'Todo 1', 'Todo 2', 'Todo 3'])
+        with CaptureQueriesContext(connection) as queries:
+            response = self._move(self.todos[3], {'after': self.todos[0].pk})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(self._move(self.todos[2], {}).status_code, status.HTTP_200_OK)
+        self.assertEqual(self._list(), ['Todo 2', 'Todo 0', 'Todo 3', 'Todo 1'])
+
+        other = Category.objects.create(user=self.user, name='Other')
+        self._move(self.todos[1], {'category': other.pk})
+        self.assertEqual(Todo.objects.get(pk=self.todos[1].pk).category, other)
+        self.assertEqual(self._list(), ['Todo 2', 'Todo 0', 'Todo 3'])
+        for data in ({'after': self.todos[0].pk}, {'after': 'first'}, {'category': 0}):
+            self.assertEqual(self._move(self.todos[0], data).status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_category_change(self):
+        other = Category.objects.create(user=self.user, name='Other')
+        first = Todo.objects.create(user=self.user, category=other, text='First')
+        todo = Todo.objects.get(pk=self.todos[0].pk)
+        todo.category = other
+        todo.save()
+        self.assertGreater(todo.position, first.position)
+
+        # Merged todos go last in their order
+        other.merge_into(self.category)
+        self.assertEqual(self._list(), ['Todo 1', 'Todo 2', 'Todo 3', 'First', 'Todo 0'])
+
+        default = Category.get_or_create_default(self.user)
+        Todo.objects.create(user=self.user, category=default, text='Default')
+        self.category.delete()
+        texts = Todo.objects.filter(category=default).order_by('position').values_list('text', flat=True)
+        self.assertEqual(list(texts), ['Default', 'Todo 1', 'Todo 2', 'Todo 3', 'First', 'Todo 0'])
+
+    def test_rebalance(self):
+        # Moves into the same gap make positions longer until the category is rebalanced
+        for i in range(40):
+            self.todos[i % 2 + 1].move(after=self.todos[0])
+        self.assertGreater(len(Todo.objects.get(pk=self.todos[1].pk).position), 4)
+        out = StringIO()
+        call_command('rebalance_positions', longer_than=4, stdout=out)
+        self.assertIn('4 todos updated', out.getvalue())
+        self.assertEqual(self._list(), ['Todo 0', 'Todo 2', 'Todo 1', 'Todo 3'])
+        self.assertLessEqual(max(len(todo.position) for todo in Todo.objects.all()), 2)
+
+
+class BatchTestCase(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        Profile(user=self.user, timezone='America/New_York').save()
+        self.category = Category.objects.create(user=self.user, name='Work')
+        self.todo = Todo.objects.create(user=self.user, category=self.category, text='Todo',
+                                        deadline=timezone.datetime(2016, 6, 1, 12, tzinfo=timezone.utc))
+        self.authorization = 'Token {0}'.format(self.user.auth_token.key)
+
+    def _batch(self, data):
+        return self.client.post('/api/batch/', json.dumps(data), content_type='application/json',
+                                HTTP_AUTHORIZATION=self.authorization)
+
+    def test_batch(self):
+        response = self._batch({'requests': [
+            {'method': 'GET', 'path': '/api/category/'},
+            {'method': 'GET', 'path': '/api/todo/?category={0}'.format(self.category.pk)},
+            {'method': 'PUT', 'path': '/api/todo/{0}/'.format(self.todo.pk), 'body': {'is_done': True}},
+            {'method': 'GET', 'path': '/api/tag/0/'},
+        ]})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        responses = response.json()
+        self.assertEqual([item['status'] for item in responses], [200, 200, 200, 404])
+        self.assertEqual([item['name'] for item in responses[0]['body']['results']], ['Work'])
+        # Time zone of the user is used by every request
+        self.assertEqual(responses[1]['body']['results'][0]['deadline'], '01.06.2016 08:00:00')
+        self.assertTrue(Todo.objects.get(pk=self.todo.pk).is_done)
+
+    def test_atomic(self):
+        response = self._batch({'atomic': True, 'requests': [
+            {'method': 'PUT', 'path': '/api/todo/{0}/'.format(self.todo.pk), 'body': {'text': 'Changed'}},
+            {'method': 'POST', 'path': '/api/tag/', 'body': {'name': 'tag', 'color': 'no color'}},
+            {'method': 'DELETE', 'path': '/api/todo/{0}/'.format(self.todo.pk)},
+        ]})
+        self.assertEqual([item['status'] for item in response.json()], [200, 400])
+        self.assertEqual(Todo.objects.get(pk=self.todo.pk).text, 'Todo')
+
+    @mock.patch.object(routers, 'replica_available', return_value=True)
+    def test_write_reads_from_primary(self, _):
+        used_replica = []
+
+        def reading_from_replica(original=routers.reading_from_replica):
+            used_replica.append(original())
+            # The test database has no replica
+            return False
+
+        with mock.patch.object(routers, 'reading_from_replica', reading_from_replica):
+            response = self._batch({'requests': [{'method': 'POST', 'path': '/api/todo/', 'body': {'text': 'New'}}]})
+        self.assertEqual(response.json()[0]['status'], status.HTTP_201_CREATED)
+        self.assertTrue(used_replica)
+        self.assertFalse(any(used_replica))
+
+    def test_headers(self):
+        self.user.is_staff = True
+        self.user.save()
+        # Headers of the batch are not passed on, every request sets its own
+        response = self.client.post('/api/batch/', json.dumps({'requests': [
+            {'method': 'GET', 'path': '/api/category/'},
+            {'method': 'GET', 'path': '/api/todo/', 'headers': {'X-Profile': '1'}},
+            {'method': 'GET', 'path': '/api/tag/', 'headers': {'Accept': 'text/csv'}},
+        ]}), content_type='application/json', HTTP_AUTHORIZATION=self.authorization, HTTP_X_PROFILE='1')
+        self.assertEqual([item['status'] for item in response.json()], [200, 200, 406])
+        self.assertEqual(sorted(RequestProfile.objects.values_list('path', flat=True)), ['/api/batch/', '/api/todo/'])
+
+    def test_invalid(self):
+        for requests in ([], [{'method': 'GET', 'path': '/api/changes/'}], [{'method': 'GET', 'path': '/admin/'}],
+                         [{'method': 'PATCH', 'path': '/api/todo/'}],
+                         [{'method': 'GET', 'path': '/api/todo/', 'headers': {'Authorization': 'Token x'}}]):
+            self.assertEqual(self._batch({'requests': requests}).status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ProvisioningTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _provision(self, lines, *args):
+        path = os.path.join(self.directory, 'users.csv')
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        out = StringIO()
+        call_command('provision_users', path, *args, stdout=out)
+        return out.getvalue()
+
+    def test_provision(self):
+        existing = get_user_model().objects.create(username='existing', email='old@example.com')
+        Profile(user=existing, timezone='Europe/Berlin').save()
+        with self.assertNumQueries(20):
+            output = self._provision(['username,email,timezone', 'new,new@example.com,America/New_York',
+                                      'other,,', 'existing,existing@example.com,'], '--batch-size', '2')
+        self.assertIn('2 users created, 1 updated', output)
+
+        users = get_user_model().objects.filter(username__in=('new', 'other', 'existing'))
+        self.assertEqual(Token.objects.filter(user__in=users).count(), 3)
+        self.assertEqual({user.username: str(user.profile.timezone) for user in users},
+                         {'new': 'America/New_York', 'other': settings.TIME_ZONE, 'existing': 'Europe/Berlin'})
+        self.assertEqual(users.get(username='existing').email, 'existing@example.com')
+        self.assertFalse(users.get(username='new').has_usable_password())
+
+        self.assertIn('0 users created, 0 updated', self._provision(['username', 'new']))
+        with self.assertRaises(CommandError):
+            self._provision(['username,timezone', 'bad,Mars/Olympus'])
+        self.assertFalse(get_user_model().objects.filter(username='bad').exists())
+        for username in ('', 'bad name', 'x' * 31):
+            with self.assertRaises(CommandError):
+                self._provision(['username', 'good', '"{0}"'.format(username)])
+        self.assertFalse(get_user_model().objects.filter(username='good').exists())
+
+    def test_batch_size(self):
+        # Users of a batch are looked up by lists of usernames, SQLite allows 999 parameters in a query
+        with self.assertRaises(CommandError):
+            self._provision(['username', 'new'], '--batch-size', '1000')
+        with self.assertRaises(ValueError):
+            provision_batch([{'username': 'user{0}'.format(i)} for i in range(1000)])
+        self.assertFalse(get_user_model().objects.filter(username='user0').exists())
+        self.assertEqual(provision_batch([{'username': 'user{0}'.format(i)} for i in range(999)]), (999, 0))
+
+    def test_update_queries(self):
+        users = [get_user_model()(username='user{0}'.format(i), email='old@example.com') for i in range(5)]
+        get_user_model().objects.bulk_create(users)
+        entries = [{'username': 'user{0}'.format(i), 'email': 'user{0}@example.com'.format(i),
+                    'first_name': 'User'} for i in range(5)]
+        provision_batch(entries)
+        entries = [dict(entry, first_name='Name {0}'.format(i)) for i, entry in enumerate(entries)]
+        # One update of the names of all users, besides savepoints and selects of users, tokens and profiles
+        with self.assertNumQueries(9):
+            self.assertEqual(provision_batch(entries), (0, 5))
+        self.assertEqual(sorted(get_user_model().objects.values_list('first_name', 'email'))[-1],
+                         ('Name 4', 'user4@example.com'))
@@ -0,0 +1,137 @@
+import sqlite3
+import threading
+
+from django.conf import settings
+from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
+
+from .metrics import metrics
+
+
+class SlidingWindowStore(object):
+    """
+    Sliding window counters shared by worker processes through a SQLite file (`THROTTLE_DATABASE`)
+
+    Every key keeps only the number of requests in the current and the previous fixed window,
+    the number of requests in the sliding window is estimated by weighting the previous one
+    by its part still covered by the sliding window, so a hit costs O(1)
+
+    Rows expire when their current window becomes older than the previous one, every `PRUNE_EVERY` hits
+    of a process delete the expired ones, so keys of clients that went away don't pile up
+    """
+    PRUNE_EVERY = 1000
+
+    def __init__(self):
+        self._local = threading.local()
+        self._hits = 0
+
+    def _connect(self, path):
+        connection = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        # Losing a few counters on power loss is fine
+        connection.execute('PRAGMA synchronous=OFF')
+        columns = [row[1] for row in connection.execute('PRAGMA table_info(throttle)')]
+        if columns and 'expires' not in columns:
+            # Counters of files created without expiry, dropping them only restarts the windows
+            connection.execute('DROP TABLE throttle')
+        connection.execute('CREATE TABLE IF NOT EXISTS throttle ('
+                           'key TEXT PRIMARY KEY, '
+                           'window INTEGER NOT NULL, '
+                           'current INTEGER NOT NULL, '
+                           'previous INTEGER NOT NULL, '
+                           'expires REAL NOT NULL'
+                           ') WITHOUT ROWID')
+        return connection
+
+    @property
+    def connection(self):
+        path = settings.THROTTLE_DATABASE
+        if getattr(self._local, 'path', None) != path:
+            self._local.connection = self._connect(path)
+            self._local.path = path
+        return self._local.connection
+
+    def hit(self, key, limit, duration, now):
+        """
+        Counts the request unless the limit is reached
+        :return: None if the request is allowed, otherwise seconds to wait
+        """
+        window = int(now // duration)
+        elapsed = now - window * duration
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT window, current, previous FROM throttle WHERE key = ?',
+                                     (key,)).fetchone()
+            current = previous = 0
+            if row is not None:
+                if row[0] == window:
+                    current, previous = row[1], row[2]
+                elif row[0] == window - 1:
+                    previous = row[1]
+
+            weight = 1 - elapsed / duration
+            if previous * weight + current + 1 > limit:
+                connection.execute('ROLLBACK')
+                if previous and current < limit:
+                    # Previous window fades out enough before this one ends
+                    return min(max(0.0, duration * (1 - (limit - current - 1) / previous) - elapsed),
+                               duration - elapsed)
+                return duration - elapsed
+
+            connection.execute('INSERT OR REPLACE INTO throttle (key, window, current, previous, expires) '
+                               'VALUES (?, ?, ?, ?, ?)', (key, window, current + 1, previous, (window + 2) * duration))
+            self._hits += 1
+            if self._hits % self.PRUNE_EVERY == 0:
+                connection.execute('DELETE FROM throttle WHERE expires <= ?', (now,))
+            connection.execute('COMMIT')
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        return None
+
+    def clear(self):
+        self.connection.execute('DELETE FROM throttle')
+
+
+store = SlidingWindowStore()
+
+
+class SlidingWindowThrottleMixin(object):
+    """
+    Replaces the timestamp history of `SimpleRateThrottle` with sliding window counters
+    """
+    store = store
+    wait_seconds = None
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.wait_seconds = self.store.hit(self.key, self.num_requests, self.duration, self.timer())
+        if self.wait_seconds is not None:
+            metrics.inc('mytodo_throttled_requests_total', (('scope', self.scope),))
+        return self.wait_seconds is None
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class AnonSlidingWindowThrottle(SlidingWindowThrottleMixin, AnonRateThrottle):
+    pass
+
+
+class UserSlidingWindowThrottle(SlidingWindowThrottleMixin, UserRateThrottle):
+    pass
+
+
+class AutocompleteThrottle(UserSlidingWindowThrottle):
+    scope = 'autocomplete'
+
+
+class ChangeFeedThrottle(UserSlidingWindowThrottle):
+    scope = 'changes'
@@ -1,11 +1,19 @@
 from django.conf.urls import url
-from .views import CategoryList, CategoryDetail, TagList, TagDetail, TodoList, TodoDetail
+from .views import (CategoryList, CategoryDetail, CategoryMerge, TagList, TagDetail, TagMerge, TodoList, TodoDetail,
+                    TodoMove, ArchivedTodoRestore, ChangeFeed, Autocomplete, Batch)
 
 urlpatterns = [
     url(r'^category/$', CategoryList.as_view(), name='category-list'),
     url(r'^category/(?P<pk>[0-9]+)/$', CategoryDetail.as_view(), name='category-detail'),
+    url(r'^category/(?P<pk>[0-9]+)/merge/$', CategoryMerge.as_view()),
     url(r'^tag/$', TagList.as_view()),
     url(r'^tag/(?P<pk>[0-9]+)/$', TagDetail.as_view()),
+    url(r'^tag/(?P<pk>[0-9]+)/merge/$', TagMerge.as_view()),
     url(r'^todo/$', TodoList.as_view()),
     url(r'^todo/(?P<pk>[0-9]+)/$', TodoDetail.as_view()),
+    url(r'^todo/(?P<pk>[0-9]+)/move/$', TodoMove.as_view()),
+    url(r'^todo/(?P<pk>[0-9]+)/restore/$', ArchivedTodoRestore.as_view()),
+    url(r'^changes/$', ChangeFeed.as_view()),
+    url(r'^autocomplete/$', Autocomplete.as_view()),
+    url(r'^batch/$', Batch.as_view()),
 ]
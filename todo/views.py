@@ -1,28 +1,187 @@
+import io
+import itertools
+import json
 import logging
+import random
+import time
 
 from rest_framework import mixins, generics, permissions, exceptions
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
+from django.core.handlers.wsgi import WSGIRequest
+from django.core.urlresolvers import Resolver404, resolve
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.utils import timezone
-
+from django.utils.crypto import constant_time_compare
+
+from .autocomplete import autocomplete, KINDS
+from .changes import change_log, TooManyListeners
+from .metrics import metrics
+from .profiling import RequestProfiler
+from .renderers import EventStreamRenderer, PrometheusRenderer
+from .throttling import (AnonSlidingWindowThrottle, UserSlidingWindowThrottle, AutocompleteThrottle,
+                         ChangeFeedThrottle)
 from .serializers import CategorySerializer, TagSerializer, TodoSerializer
-from .models import Category, Tag, Todo
+from .models import Category, Tag, Todo, ArchivedTodo, UserShard, RequestProfile
+from . import routers
 
 
 logger = logging.getLogger(__name__)
 
 
+class UserMoving(exceptions.APIException):
+    status_code = 503
+    default_detail = 'Your data is being moved, try again in a few seconds.'
+
+
+class ChangeFeedBusy(exceptions.APIException):
+    status_code = 503
+    default_detail = 'Too many clients are waiting for changes, try again in a few seconds.'
+
+
+class QuerySetChain(object):
+    """
+    Concatenation of querysets that can be counted and sliced without fetching all of them
+    """
+    def __init__(self, *querysets):
+        self.querysets = querysets
+        self._counts = None
+
+    def counts(self):
+        if self._counts is None:
+            self._counts = [q.count() for q in self.querysets]
+        return self._counts
+
+    def count(self):
+        return sum(self.counts())
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        return itertools.chain(*self.querysets)
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            raise TypeError('QuerySetChain supports only slicing')
+        start, stop = item.start or 0, item.stop
+        result = []
+        for q, count in zip(self.querysets, self.counts()):
+            if stop is not None and stop <= 0:
+                break
+            if start < count:
+                result.extend(q[start:stop])
+            start = max(0, start - count)
+            if stop is not None:
+                stop -= count
+        return result
+
+
 class MyGenericApiView(generics.GenericAPIView):
     # Disabling "options" method
     metadata_class = None
+    throttle_classes = (AnonSlidingWindowThrottle, UserSlidingWindowThrottle)
+
+    profiler = None
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            response = super().dispatch(request, *args, **kwargs)
+            if self.profiler is not None:
+                # Rendering is profiled too
+                if hasattr(response, 'render'):
+                    response.render()
+                self.profiler.stop()
+                profile = RequestProfile.record(self.request, response, self.profiler)
+                response['X-Profile-Id'] = profile.pk
+            return response
+        finally:
+            if self.profiler is not None and self.profiler.duration is None:
+                self.profiler.stop()
+            routers.stop_replica_reads()
+
+    @staticmethod
+    def wants_profile(request):
+        """
+        :return: True if the request of a staff user asks to be profiled or is sampled
+        """
+        if not request.user.is_staff:
+            return False
+        return (request.META.get('HTTP_X_PROFILE') == '1' or request.query_params.get('profile') == '1' or
+                random.random() < settings.PROFILE_SAMPLE_RATE)
+
+    def is_write(self, request):
+        """
+        :return: True if the request may write, it is routed to the primary and pins the user to it
+        """
+        return request.method not in permissions.SAFE_METHODS
 
     def initial(self, request, *args, **kwargs):
         super().initial(request, *args, **kwargs)
+        if self.wants_profile(request):
+            self.profiler = RequestProfiler(settings.PROFILE_INTERVAL)
+            self.profiler.start()
+        # Users created since the replica was synced have their profile only on the primary
         timezone.activate(request.user.profile.timezone)
+        if not self.is_write(request):
+            routers.start_replica_reads(request.user)
+        else:
+            # Reads of a write, or of a batch running it, see the primary
+            routers.stop_replica_reads()
+            if UserShard.is_moving(request.user.pk):
+                raise UserMoving()
+            routers.pin_to_primary(request.user)
 
     @staticmethod
     def _raise_invalid_param(param_name):
         raise exceptions.ParseError('parameter `{0}` is invalid'.format(param_name))
 
+    def get_requested_fields(self):
+        """
+        Parses `fields` GET param, comma separated names of serializer fields to return
+        :return: list of field names or None if all fields are requested
+        """
+        param = self.request.query_params.get('fields')
+        if param is None or self.request.method not in permissions.SAFE_METHODS:
+            return None
+        fields = [name for name in param.split(',') if name]
+        if not fields or not set(fields) <= set(self.get_serializer_class().Meta.fields):
+            self._raise_invalid_param('fields')
+        return fields
+
+    def narrow_queryset(self, q, fields):
+        """
+        Selects only columns of the requested fields and prefetches only requested many-to-many relations
+        """
+        if isinstance(q, QuerySetChain):
+            return QuerySetChain(*(self.narrow_queryset(part, fields) for part in q.querysets))
+        columns, relations = [], []
+        for name in fields:
+            try:
+                field = q.model._meta.get_field(name)
+            except FieldDoesNotExist:
+                return q
+            (relations if field.many_to_many else columns).append(name)
+        return q.only(*columns).prefetch_related(None).prefetch_related(*relations)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        fields = self.get_requested_fields()
+        if fields is not None:
+            queryset = self.narrow_queryset(queryset, fields)
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_requested_fields()
+        if fields is not None:
+            kwargs['fields'] = fields
+        return super().get_serializer(*args, **kwargs)
+
     def parse_get_int(self, param_name, default=None):
         param = self.request.query_params.get(param_name, default)
         if param != default:
@@ -48,6 +207,22 @@ class MyGenericApiView(generics.GenericAPIView):
         return methods
 
 
+class MergeMixin(object):
+    """
+    Merges the object into the one with `target` id from the request body, responds with the target
+    """
+    def merge(self, request, *args, **kwargs):
+        source = self.get_object()
+        try:
+            target = self.get_queryset().get(pk=int(request.data.get('target')))
+        except (TypeError, ValueError, ObjectDoesNotExist):
+            self._raise_invalid_param('target')
+        if target.pk == source.pk:
+            self._raise_invalid_param('target')
+        source.merge_into(target)
+        return Response(self.get_serializer(target).data)
+
+
 class CategoryList(mixins.ListModelMixin,
                    mixins.CreateModelMixin,
                    MyGenericApiView):
@@ -55,7 +230,7 @@ class CategoryList(mixins.ListModelMixin,
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        return Category.objects.filter(user=self.request.user)
+        return Category.objects.for_user(self.request.user)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -75,7 +250,7 @@ class CategoryDetail(mixins.RetrieveModelMixin,
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        return Category.objects.filter(user=self.request.user)
+        return Category.objects.for_user(self.request.user)
 
     def get(self, request, *args, **kwargs):
         return self.retrieve(request, *args, **kwargs)
@@ -87,6 +262,17 @@ class CategoryDetail(mixins.RetrieveModelMixin,
         return self.destroy(request, *args, **kwargs)
 
 
+class CategoryMerge(MergeMixin, MyGenericApiView):
+    serializer_class = CategorySerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        return Category.objects.for_user(self.request.user)
+
+    def post(self, request, *args, **kwargs):
+        return self.merge(request, *args, **kwargs)
+
+
 class TagList(mixins.ListModelMixin,
               mixins.CreateModelMixin,
               MyGenericApiView):
@@ -94,7 +280,7 @@ class TagList(mixins.ListModelMixin,
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        return Tag.objects.filter(user=self.request.user)
+        return Tag.objects.for_user(self.request.user)
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -114,7 +300,7 @@ class TagDetail(mixins.RetrieveModelMixin,
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        return Tag.objects.filter(user=self.request.user)
+        return Tag.objects.for_user(self.request.user)
 
     def get(self, request, *args, **kwargs):
         return self.retrieve(request, *args, **kwargs)
@@ -126,6 +312,17 @@ class TagDetail(mixins.RetrieveModelMixin,
         return self.destroy(request, *args, **kwargs)
 
 
+class TagMerge(MergeMixin, MyGenericApiView):
+    serializer_class = TagSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        return Tag.objects.for_user(self.request.user)
+
+    def post(self, request, *args, **kwargs):
+        return self.merge(request, *args, **kwargs)
+
+
 class TodoList(mixins.ListModelMixin,
                mixins.CreateModelMixin,
                MyGenericApiView):
@@ -143,9 +340,31 @@ class TodoList(mixins.ListModelMixin,
         only_one_day: if specified changes behaviour of by_date(see below) to show todos only for one day
         by_date: if specified todos will be filtered by this date,
         if it is equal to `None`, filters todos without deadline
+        include_archived: if equal to 1, archived todos are listed after the active ones
+        ordering: `deadline` (default) or `position`, the order todos were put in by moving them,
+        category by category
         :return: queryset
         """
-        q = Todo.objects.filter(user=self.request.user)
+        only_done = self.parse_get_bool('only_done')
+        include_archived = self.parse_get_bool('include_archived', False)
+        ordering = self.request.query_params.get('ordering', 'deadline')
+        if ordering not in ('deadline', 'position'):
+            self._raise_invalid_param('ordering')
+
+        querysets = [self.filter_todos(Todo.objects.for_user(self.request.user))]
+        # Archive has only done todos
+        if include_archived and only_done is not False:
+            querysets.append(self.filter_todos(ArchivedTodo.objects.for_user(self.request.user)))
+        querysets = [q.prefetch_related('tags') for q in querysets]
+        if ordering == 'position':
+            # Todos are served by the index on (user, category, position)
+            querysets = [q.order_by('category', 'position', 'pk') for q in querysets]
+        return QuerySetChain(*querysets) if len(querysets) > 1 else querysets[0]
+
+    def filter_todos(self, q):
+        """
+        Applies filters from GET params (see `get_queryset`) to todos or archived todos
+        """
         only_done = self.parse_get_bool('only_done')
         only_one_day = self.parse_get_bool('only_one_day', False)
         category = self.request.query_params.get('category')
@@ -198,7 +417,7 @@ class TodoList(mixins.ListModelMixin,
             else:
                 q = q.filter(deadline__lte=date)
 
-        return q.prefetch_related('tags')
+        return q
 
     def perform_create(self, serializer):
         serializer.save(user=self.request.user)
@@ -218,7 +437,7 @@ class TodoDetail(mixins.RetrieveModelMixin,
     permission_classes = (permissions.IsAuthenticated,)
 
     def get_queryset(self):
-        return Todo.objects.filter(user=self.request.user)
+        return Todo.objects.for_user(self.request.user)
 
     def get(self, request, *args, **kwargs):
         return self.retrieve(request, *args, **kwargs)
@@ -228,3 +447,261 @@ class TodoDetail(mixins.RetrieveModelMixin,
 
     def delete(self, request, *args, **kwargs):
         return self.destroy(request, *args, **kwargs)
+
+
+class TodoMove(MyGenericApiView):
+    """
+    Moves the todo right after the todo with `after` id from the request body, into the category of that todo.
+    Without `after` the todo becomes the first one of the category with `category` id, its own by default
+    """
+    serializer_class = TodoSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        return Todo.objects.for_user(self.request.user)
+
+    def _get_param_object(self, queryset, param_name):
+        value = self.request.data.get(param_name)
+        if value is None:
+            return None
+        try:
+            return queryset.get(pk=int(value))
+        except (TypeError, ValueError, ObjectDoesNotExist):
+            self._raise_invalid_param(param_name)
+
+    def post(self, request, *args, **kwargs):
+        todo = self.get_object()
+        after = self._get_param_object(self.get_queryset(), 'after')
+        if after is not None and after.pk == todo.pk:
+            self._raise_invalid_param('after')
+        category = self._get_param_object(Category.objects.for_user(request.user), 'category')
+        todo.move(after, category)
+        return Response(self.get_serializer(todo).data)
+
+
+class ArchivedTodoRestore(MyGenericApiView):
+    serializer_class = TodoSerializer
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get_queryset(self):
+        return ArchivedTodo.objects.for_user(self.request.user)
+
+    def post(self, request, *args, **kwargs):
+        todo = self.get_object().restore()
+        return Response(self.get_serializer(todo).data)
+
+
+class ChangeFeed(MyGenericApiView):
+    """
+    Create, update and delete events of the user's todos, tags and categories
+
+    Responds with an event stream to `Accept: text/event-stream`, resuming after `Last-Event-ID`.
+    Otherwise long-polls: waits up to `timeout` seconds for events after the `since` id;
+    without `since` returns only the id to start from. `reset` means events were pruned
+    and everything has to be fetched again.
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (ChangeFeedThrottle,)
+    renderer_classes = tuple(api_settings.DEFAULT_RENDERER_CLASSES) + (EventStreamRenderer,)
+
+    def get(self, request, *args, **kwargs):
+        if isinstance(request.accepted_renderer, EventStreamRenderer):
+            since = request.META.get('HTTP_LAST_EVENT_ID')
+            try:
+                since = change_log.last_id() if since is None else int(since)
+            except ValueError:
+                self._raise_invalid_param('Last-Event-ID')
+            response = StreamingHttpResponse(self.stream(request.user.pk, since), content_type='text/event-stream')
+            response['Cache-Control'] = 'no-cache'
+            return response
+
+        since = self.parse_get_int('since')
+        if since is None:
+            return Response({'last_id': change_log.last_id(), 'events': [], 'reset': False})
+        timeout = min(self.parse_get_int('timeout', settings.CHANGES_POLL_SECONDS), settings.CHANGES_POLL_SECONDS)
+        try:
+            with change_log.listening():
+                events = change_log.wait(request.user.pk, since, max(timeout, 0))
+        except TooManyListeners:
+            raise ChangeFeedBusy()
+        return Response({
+            'last_id': events[-1]['id'] if events else since,
+            'events': events,
+            'reset': change_log.is_expired(since),
+        })
+
+    @staticmethod
+    def stream(user_pk, since):
+        """
+        Yields events as they come until `CHANGES_STREAM_SECONDS` pass, the client reconnects then,
+        or right away if the worker has too many clients
+        """
+        end = time.time() + settings.CHANGES_STREAM_SECONDS
+        try:
+            with change_log.listening():
+                if change_log.is_expired(since):
+                    yield 'event: reset\ndata: {}\n\n'
+                while time.time() < end:
+                    events = change_log.wait(user_pk, since, min(settings.CHANGES_HEARTBEAT_SECONDS, end - time.time()))
+                    if not events:
+                        # Heartbeat, lets the server notice gone clients
+                        yield ': ping\n\n'
+                    for event in events:
+                        since = event['id']
+                        yield 'id: {0}\nevent: change\ndata: {1}\n\n'.format(since, json.dumps(event))
+        except TooManyListeners:
+            # Clients reconnect after `retry` milliseconds
+            yield 'retry: {0}\nevent: busy\ndata: {{}}\n\n'.format(settings.CHANGES_HEARTBEAT_SECONDS * 1000)
+
+
+class Autocomplete(MyGenericApiView):
+    """
+    Tags and categories of the user whose names start with `q`, most used first
+
+    Available GET params:
+    q: prefix, case-insensitive; until names of the user are indexed in memory it is matched as typed,
+       in lower case and capitalized only
+    kind: `tag` or `category`, both if not specified
+    limit: number of results, 10 by default, at most 50
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    throttle_classes = (AutocompleteThrottle,)
+    MAX_LIMIT = 50
+
+    def get(self, request, *args, **kwargs):
+        prefix = request.query_params.get('q', '')
+        kind = request.query_params.get('kind')
+        if kind is not None and kind not in KINDS:
+            self._raise_invalid_param('kind')
+        limit = self.parse_get_int('limit', 10)
+        if not 0 < limit <= self.MAX_LIMIT:
+            self._raise_invalid_param('limit')
+
+        entries = autocomplete.search(request.user, prefix, (kind,) if kind else tuple(KINDS), limit)
+        return Response([{'kind': entry.kind, 'id': entry.id, 'name': entry.name, 'usage': entry.usage}
+                         for entry in entries])
+
+
+class Batch(MyGenericApiView):
+    """
+    Runs several API requests in one round trip, authenticated once and in the time zone of this request
+
+    Body: `requests`, list of {"method", "path", "body", "headers"} with paths of the API like
+    `/api/todo/?category=1` and optional `Accept` and `X-Profile` headers, and `atomic`: if true, the requests
+    run in one transaction which is rolled back when one of them fails, requests after the failed one are not run.
+    Responds with a list of {"status", "body"} in the order of the requests
+    """
+    permission_classes = (permissions.IsAuthenticated,)
+    # Every request of the batch is throttled by its own view
+    throttle_classes = ()
+    METHODS = ('GET', 'POST', 'PUT', 'DELETE')
+    # Headers a request of the batch may set, others are not taken from this request either
+    HEADERS = {'Accept': 'HTTP_ACCEPT', 'X-Profile': 'HTTP_X_PROFILE'}
+    # Entries of this request's META the requests of the batch share, for absolute URLs and client addresses
+    SHARED_META = ('HTTP_AUTHORIZATION', 'HTTP_HOST', 'HTTP_X_FORWARDED_FOR', 'HTTP_X_FORWARDED_HOST',
+                   'HTTP_X_FORWARDED_PROTO', 'HTTPS', 'REMOTE_ADDR', 'SCRIPT_NAME', 'SERVER_NAME', 'SERVER_PORT',
+                   'SERVER_PROTOCOL')
+
+    def is_write(self, request):
+        # Requests of the batch that write route themselves to the primary
+        return False
+
+    @staticmethod
+    def resolve_view(path):
+        """
+        :return: `ResolverMatch` of an API view that can be batched or None
+        """
+        try:
+            match = resolve(path)
+        except Resolver404:
+            return None
+        view_class = getattr(match.func, 'cls', None)
+        # Long polls and streams would hold up the whole batch
+        if match.namespace != 'todo' or view_class in (Batch, ChangeFeed):
+            return None
+        return match
+
+    def parse_requests(self):
+        """
+        :return: list of (method, path, query string, body, headers, `ResolverMatch`)
+        """
+        items = self.request.data.get('requests') if isinstance(self.request.data, dict) else None
+        if not isinstance(items, list) or not 0 < len(items) <= settings.BATCH_MAX_REQUESTS:
+            self._raise_invalid_param('requests')
+        parsed = []
+        for item in items:
+            if not isinstance(item, dict) or item.get('method') not in self.METHODS:
+                self._raise_invalid_param('requests')
+            headers = item.get('headers') or {}
+            if not isinstance(headers, dict) or not all(
+                    name in self.HEADERS and isinstance(value, str) for name, value in headers.items()):
+                raise exceptions.ParseError('requests of a batch may only set headers {0}'.format(
+                    ', '.join(sorted(self.HEADERS))))
+            path, _, query_string = str(item.get('path', '')).partition('?')
+            match = self.resolve_view(path)
+            if match is None:
+                raise exceptions.ParseError('path `{0}` is not an API view that can be batched'.format(path))
+            parsed.append((item['method'], path, query_string, item.get('body'), headers, match))
+        return parsed
+
+    def make_request(self, method, path, query_string, body, headers):
+        """
+        :return: `HttpRequest` with the server and client of this request, its own headers
+            and the user this request is authenticated as
+        """
+        data = b'' if body is None else json.dumps(body, cls=JSONEncoder).encode('utf-8')
+        environ = {key: value for key, value in self.request.META.items()
+                   if key in self.SHARED_META or key.startswith('wsgi.')}
+        environ.update({self.HEADERS[name]: value for name, value in headers.items()})
+        environ.update(REQUEST_METHOD=method, PATH_INFO=path, QUERY_STRING=query_string,
+                       CONTENT_TYPE='application/json', CONTENT_LENGTH=str(len(data)))
+        environ['wsgi.input'] = io.BytesIO(data)
+        request = WSGIRequest(environ)
+        # Read by `rest_framework.request.Request` instead of running the authentication classes again
+        request._force_auth_user = self.request.user
+        request._force_auth_token = self.request.auth
+        return request
+
+    def run(self, requests, stop_on_error):
+        responses = []
+        for method, path, query_string, body, headers, match in requests:
+            request = self.make_request(method, path, query_string, body, headers)
+            response = match.func(request, *match.args, **match.kwargs)
+            responses.append({'status': response.status_code, 'body': getattr(response, 'data', None)})
+            if stop_on_error and response.status_code >= 400:
+                break
+        return responses
+
+    def post(self, request, *args, **kwargs):
+        requests = self.parse_requests()
+        if not request.data.get('atomic', False):
+            return Response(self.run(requests, stop_on_error=False))
+        alias = UserShard.get_alias(request.user.pk)
+        with transaction.atomic(using=alias):
+            responses = self.run(requests, stop_on_error=True)
+            if responses[-1]['status'] >= 400:
+                transaction.set_rollback(True, using=alias)
+        return Response(responses)
+
+
+class IsStaffOrMetricsToken(permissions.BasePermission):
+    """
+    Allows staff users and requests with `Authorization: Bearer <METRICS_TOKEN>`
+    """
+    def has_permission(self, request, view):
+        token = settings.METRICS_TOKEN
+        authorization = request.META.get('HTTP_AUTHORIZATION', '')
+        if token and constant_time_compare(authorization, 'Bearer {0}'.format(token)):
+            return True
+        return request.user.is_staff
+
+
+class MetricsExposition(APIView):
+    """
+    Metrics of all workers in the Prometheus text format
+    """
+    permission_classes = (IsStaffOrMetricsToken,)
+    renderer_classes = (PrometheusRenderer,)
+
+    def get(self, request, *args, **kwargs):
+        return Response(metrics.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
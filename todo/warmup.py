@@ -0,0 +1,82 @@
+import gc
+
+import pytz
+from django.core.urlresolvers import get_resolver
+from django.db import connections
+from django.utils import timezone
+from rest_framework.settings import api_settings
+
+
+def _warm_up_resolver(resolver):
+    # Builds the reverse lookup tables and compiles every pattern of the resolver
+    resolver.reverse_dict
+    for pattern in resolver.url_patterns:
+        pattern.regex
+        if hasattr(pattern, 'url_patterns'):
+            yield from _warm_up_resolver(pattern)
+        else:
+            yield pattern.callback
+
+
+def warm_up_urls():
+    """
+    :return: view callbacks of all URL patterns
+    """
+    return list(_warm_up_resolver(get_resolver()))
+
+
+def warm_up_views(callbacks):
+    """
+    Instantiates renderers, parsers and serializer fields of DRF views, so their imports and model metadata are loaded
+    """
+    for name in ('DEFAULT_RENDERER_CLASSES', 'DEFAULT_PARSER_CLASSES', 'DEFAULT_AUTHENTICATION_CLASSES',
+                 'DEFAULT_PERMISSION_CLASSES', 'DEFAULT_THROTTLE_CLASSES', 'DEFAULT_CONTENT_NEGOTIATION_CLASS',
+                 'DEFAULT_PAGINATION_CLASS'):
+        getattr(api_settings, name)
+    for callback in callbacks:
+        view_class = getattr(callback, 'cls', None)
+        if view_class is None:
+            continue
+        view = view_class()
+        view.get_renderers()
+        view.get_parsers()
+        serializer_class = getattr(view_class, 'serializer_class', None)
+        if serializer_class is not None:
+            serializer_class().fields
+
+
+def warm_up_timezones():
+    """
+    Loads the zone files `TimeZoneField` accepts
+    """
+    timezone.get_default_timezone()
+    for name in pytz.common_timezones:
+        pytz.timezone(name)
+
+
+def warm_up_handler(handler):
+    """
+    Loads the middleware, which the WSGI handler otherwise does on its first request
+    """
+    if handler._request_middleware is None:
+        handler.load_middleware()
+
+
+def warm_up(handler=None, freeze=True):
+    """
+    Builds what Django and DRF otherwise build lazily on the first requests of every worker.
+    Called before forking, workers share the result through copy-on-write
+
+    :param handler: WSGI handler whose middleware to load
+    :param freeze: move everything allocated so far out of the garbage collector's reach (Python 3.7+),
+        so collections in workers don't touch, and so copy, the shared pages
+    """
+    if handler is not None:
+        warm_up_handler(handler)
+    warm_up_views(warm_up_urls())
+    warm_up_timezones()
+    # Workers must not inherit open database connections
+    connections.close_all()
+    gc.collect()
+    if freeze and hasattr(gc, 'freeze'):
+        gc.freeze()